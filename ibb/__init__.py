@@ -5,6 +5,8 @@
 # Distributed under the terms of the Modified BSD License.
 
 from ._version import __version__, version_info
+from ._cache import ImageCache, DiskCache
+from ._region import RegionReader, ArrayReader, PILReader, TiffReader, ImagePyramid, open_region
 from .widgets import ImageViewer, BramboxViewer, TorchViewer, CutoutViewer, PatchViewer
 
 
@@ -0,0 +1,375 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from ._util import is_memmap, read_image
+
+__all__ = ['ImageCache', 'ImagePrefetcher', 'DiskCache']
+
+
+class ImageCache:
+    """
+    Thread-safe LRU cache for decoded images, which evicts images based on their memory usage. |br|
+    A single cache can be shared between multiple viewers that look at the same dataset.
+
+    Args:
+        max_bytes (int): Memory budget of the cache in bytes; Default **512MiB**
+
+    Note:
+        Memory-mapped images do not count towards the memory budget, as their data lives in the OS page cache. |br|
+        Values that use more memory after they were added (eg. a :class:`~ibb.RegionReader` that decodes its image on the first read)
+        should be re-accounted with :meth:`ImageCache.update`.
+
+    Note:
+        The most recently added image is always kept, even if it is bigger than `max_bytes`.
+        Viewers additionally pin the image they are showing with :meth:`ImageCache.pin`,
+        so that prefetched images do not evict it and viewers that show multiple views of the same image (eg. patches or cutouts) do not need to reload it.
+    """
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        nbytes = _nbytes(value)
+
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data[key][1]
+            self._data[key] = (value, nbytes)
+            self._data.move_to_end(key)
+            self.nbytes += nbytes
+            self._evict(key)
+
+    def update(self, key):
+        """ Recompute the memory usage of a cached value and evict other images if it no longer fits in the budget. """
+        with self._lock:
+            if key not in self._data:
+                return
+
+            value, previous = self._data[key]
+            nbytes = _nbytes(value)
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes - previous
+            self._evict(key)
+
+    def pin(self, key, owner=None):
+        """
+        Protect a key from being evicted, until the same owner pins another key. |br|
+        The key does not need to be in the cache yet, so it can be pinned before loading the image.
+
+        Args:
+            key (hashable): Key to pin or None to remove the pin of the owner
+            owner (hashable): Identifier of the owner of the pin, so that multiple viewers can share the cache; Default **None**
+        """
+        with self._lock:
+            if key is None:
+                self._pins.pop(owner, None)
+            else:
+                self._pins[owner] = key
+
+    def _evict(self, newest):
+        if self.nbytes <= self.max_bytes:
+            return
+
+        pinned = set(self._pins.values())
+        for key in list(self._data):
+            if self.nbytes <= self.max_bytes:
+                break
+            if key == newest or key in pinned:
+                continue
+
+            _, evicted = self._data.pop(key)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self):
+        """ Dictionary with the hits, misses, evictions, number of entries and memory usage of the cache. """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._data),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def __repr__(self):
+        stats = ', '.join(f'{k}={v}' for k, v in self.stats.items())
+        return f'{self.__class__.__name__}({stats})'
+
+
+def _nbytes(value):
+    return 0 if is_memmap(value) else getattr(value, 'nbytes', 0)
+
+
+class ImagePrefetcher:
+    """
+    Loads images in a background thread pool and stores them in an :class:`~ibb.ImageCache`.
+
+    Args:
+        load_fn (callable): Function that takes a key and returns the decoded image
+        cache (ImageCache): Cache to store the decoded images
+        workers (int): Number of background threads; Default **2**
+    """
+    def __init__(self, load_fn, cache, workers=2):
+        self.load_fn = load_fn
+        self.cache = cache
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ibb-prefetch')
+
+    def get(self, key):
+        """ Get an image from the cache, wait for it if it is being prefetched or load it synchronously otherwise. """
+        # Background loads are stored in the cache before they leave pending, so checking both under the lock never misses them
+        with self._lock:
+            img = self.cache.get(key)
+            if img is not None:
+                return img
+            future = self._pending.get(key)
+
+        if future is not None:
+            return future.result()
+
+        img = self.load_fn(key)
+        self.cache.put(key, img)
+        return img
+
+    def prefetch(self, keys):
+        """ Schedule loading the images of the given keys in the background (in order). """
+        with self._lock:
+            for key in keys:
+                if key in self._pending or key in self.cache:
+                    continue
+                self._pending[key] = self._executor.submit(self._load, key)
+
+    def shutdown(self):
+        """ Cancel the scheduled loads and stop the background threads once the running loads finish. """
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _load(self, key):
+        try:
+            img = self.load_fn(key)
+            self.cache.put(key, img)
+            return img
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+
+class DiskCache:
+    """
+    Persistent cache that stores decoded (and resized) images as `.npy` files in a local directory,
+    so that they can be memory-mapped instead of decoded again in later sessions. |br|
+    A single cache can be shared between multiple viewers and can be reused across kernel restarts.
+
+    Images are keyed by their source path, modification time and file size, so that changed files are decoded again.
+    Resized versions of a cached image are additionally keyed by their resolution.
+
+    Args:
+        directory (str or pathlib.Path): Directory to store the cached images
+        max_bytes (int): Maximal size of the cache on disk in bytes; Default **4GiB**
+
+    Note:
+        When the cache exceeds `max_bytes`, the least recently used images are removed. |br|
+        Usage is tracked with the modification time of the cached files, so the order is kept across sessions.
+
+    Note:
+        The cache only manages the files it writes itself, which are named `ibb-<hash>.npy`.
+        Other files in the directory are never indexed or removed, but it is still best to use a dedicated directory.
+    """
+    prefix = 'ibb-'
+    pattern = re.compile(r'ibb-[0-9a-f]{40}\.npy')
+    tmp_pattern = re.compile(r'ibb-[0-9a-f]{40}\.npy\.\d+\.\d+\.tmp')
+    tmp_age = 3600
+
+    def __init__(self, directory, max_bytes=4 * 2**30):
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.directory = self.directory.resolve()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Index existing files in least to most recently used order
+        files = []
+        for f in os.scandir(self.directory):
+            if self.pattern.fullmatch(f.name):
+                files.append((f.stat(), f.name))
+            elif self.tmp_pattern.fullmatch(f.name):
+                # Remove leftovers of interrupted writes, but not the ones that other processes might still be writing
+                try:
+                    if time.time() - f.stat().st_mtime > self.tmp_age:
+                        os.remove(f.path)
+                except OSError:
+                    pass
+
+        for stat, name in sorted(files, key=lambda f: f[0].st_mtime_ns):
+            self._files[name] = stat.st_size
+            self.nbytes += stat.st_size
+        self._evict()
+
+    def load(self, path, load_fn=read_image):
+        """
+        Get the decoded image of a file from the cache or decode it with `load_fn` and store it.
+
+        Args:
+            path (str or pathlib.Path): Path to the image file
+            load_fn (callable): Function that decodes the image file to a numpy array; Default **read_image**
+
+        Returns:
+            numpy.memmap: Memory-mapped decoded image
+        """
+        path = Path(path).resolve()
+        stat = path.stat()
+        return self._load(f'{path}|{stat.st_mtime_ns}|{stat.st_size}', lambda: load_fn(path))
+
+    def load_resized(self, img, size, resize_fn):
+        """
+        Get a resized version of an image that was returned by :meth:`DiskCache.load`, or resize it with `resize_fn` and store it.
+
+        Args:
+            img (numpy.ndarray): Decoded image
+            size (tuple of 2 int): Target width and height
+            resize_fn (callable): Function that takes the image and size and returns the resized image
+
+        Returns:
+            numpy.ndarray: Resized image (memory-mapped if the original image came from this cache)
+        """
+        source = self.source(img)
+        if source is None:
+            return resize_fn(img, size)
+
+        return self._load(f'{source}|{size[0]}x{size[1]}', lambda: resize_fn(img, size))
+
+    def source(self, img):
+        """ Return the name of the cached file if the image is an entire image that was loaded from this cache, otherwise None. """
+        mapped = img
+        while isinstance(mapped, np.ndarray) and not isinstance(mapped, np.memmap):
+            mapped = mapped.base
+        if not isinstance(mapped, np.memmap) or mapped.filename is None or not img.flags.c_contiguous:
+            return None
+
+        filename = Path(mapped.filename).resolve()
+        if filename.parent != self.directory or filename.name not in self._files:
+            return None
+        if img.nbytes != self._files[filename.name] - mapped.offset:
+            return None
+        return filename.name
+
+    def _load(self, key, load_fn):
+        name = f'{self.prefix}{hashlib.sha1(key.encode()).hexdigest()}.npy'
+        path = self.directory / name
+
+        with self._lock:
+            cached = name in self._files
+            if cached:
+                self.hits += 1
+                self._files.move_to_end(name)
+            else:
+                self.misses += 1
+
+        if cached:
+            try:
+                os.utime(path)
+                return np.load(path, mmap_mode='r')
+            except (OSError, ValueError):
+                # File was removed or corrupted (eg. by another process), so we recreate it
+                with self._lock:
+                    self.nbytes -= self._files.pop(name, 0)
+
+        img = np.ascontiguousarray(load_fn())
+        tmp = path.with_name(f'{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp, path)
+        nbytes = path.stat().st_size
+
+        with self._lock:
+            self.nbytes += nbytes - self._files.get(name, 0)
+            self._files[name] = nbytes
+            self._files.move_to_end(name)
+            self._evict()
+
+        return np.load(path, mmap_mode='r')
+
+    def _evict(self):
+        # Remove least recently used files, but always keep the most recent one
+        while self.nbytes > self.max_bytes and len(self._files) > 1:
+            evicted, evicted_bytes = self._files.popitem(last=False)
+            self.nbytes -= evicted_bytes
+            self.evictions += 1
+            try:
+                os.remove(self.directory / evicted)
+            except OSError:
+                pass
+
+    def clear(self):
+        """ Remove all cached images from disk. """
+        with self._lock:
+            for name in self._files:
+                try:
+                    os.remove(self.directory / name)
+                except OSError:
+                    pass
+            self._files.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self):
+        """ Dictionary with the hits, misses, evictions, number of entries and disk usage of the cache. """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._files),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def __repr__(self):
+        stats = ', '.join(f'{k}={v}' for k, v in self.stats.items())
+        return f'{self.__class__.__name__}({self.directory}, {stats})'
@@ -0,0 +1,397 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from math import ceil
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from ._util import is_memmap
+
+try:
+    import tifffile
+    import zarr
+except ImportError:
+    tifffile = None
+    zarr = None
+
+__all__ = ['RegionReader', 'ArrayReader', 'PILReader', 'TiffReader', 'ImagePyramid', 'open_region']
+
+
+class RegionReader:
+    """
+    Base class for images that can read rectangular regions without decoding the entire image. |br|
+    Regions can be read with the :meth:`RegionReader.read` method or by slicing the reader like a numpy array:
+
+    >>> reader[y0:y1, x0:x1]
+
+    Subclasses should set the `shape` attribute to the (H, W[, C]) shape of the full image and implement :meth:`RegionReader.read`.
+    """
+    shape = None
+    nbytes = 0
+
+    def read(self, x0, y0, x1, y1):
+        """ Return the region [x0:x1, y0:y1] of the image as a numpy array. """
+        raise NotImplementedError('abstractmethod')
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or len(key) != 2 or not all(isinstance(k, slice) and k.step in (None, 1) for k in key):
+            raise IndexError(f'{self.__class__.__name__} can only be indexed with 2 slices without step [{key}]')
+
+        # Use numpy slicing semantics
+        y0, y1, _ = key[0].indices(self.shape[0])
+        x0, x1, _ = key[1].indices(self.shape[1])
+        return self.read(x0, y0, max(x0, x1), max(y0, y1))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(shape={self.shape})'
+
+
+class ArrayReader(RegionReader):
+    """
+    Reads regions from numpy arrays, including memory-mapped arrays which are only read from disk when a region gets accessed.
+
+    Args:
+        array (numpy.ndarray): Image array
+    """
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+
+    @property
+    def nbytes(self):
+        # Memory-mapped arrays do not take up any memory until their pages are read
+        return 0 if is_memmap(self.array) else self.array.nbytes
+
+    def read(self, x0, y0, x1, y1):
+        return np.asarray(self.array[y0:y1, x0:x1])
+
+
+class PILReader(RegionReader):
+    """
+    Reads regions from image files with PIL. |br|
+    Uncompressed images (eg. raw TIFF, BMP, PPM) are memory-mapped directly from the file, using the tile information of PIL.
+    Other images are decoded entirely on the first read.
+
+    Args:
+        path (str or pathlib.Path): Path to the image
+    """
+    # PIL raw modes that can be memory-mapped: rawmode -> (mode, channel order)
+    rawmodes = {
+        'L': ('L', None),
+        'RGB': ('RGB', None),
+        'RGBA': ('RGBA', None),
+        'BGR': ('RGB', [2, 1, 0]),
+        'BGRA': ('RGBA', [2, 1, 0, 3]),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.lock = threading.Lock()
+
+        with Image.open(path) as img:
+            width, height = img.size
+            channels = len(img.getbands())
+            self.shape = (height, width) if channels == 1 else (height, width, channels)
+            self.reader = self._memmap(img)
+
+    @property
+    def nbytes(self):
+        return self.reader.nbytes if self.reader is not None else 0
+
+    def read(self, x0, y0, x1, y1):
+        if self.reader is None:
+            with self.lock:
+                if self.reader is None:
+                    self.reader = ArrayReader(np.asarray(Image.open(self.path)))
+
+        return self.reader.read(x0, y0, x1, y1)
+
+    def _memmap(self, img):
+        if len(img.tile) != 1:
+            return None
+
+        codec, extents, offset, args = img.tile[0]
+        if codec != 'raw' or tuple(extents) != (0, 0, *img.size):
+            return None
+
+        rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+        if rawmode not in self.rawmodes or self.rawmodes[rawmode][0] != img.mode:
+            return None
+
+        width, height = img.size
+        channels = len(rawmode)
+        stride = stride or width * channels
+        if offset + stride * height > os.path.getsize(self.path):
+            return None
+
+        data = np.memmap(self.path, dtype=np.uint8, mode='r', offset=offset, shape=(height, stride))
+        data = data[:, :width * channels].reshape(height, width, channels)
+        if orientation < 0:
+            data = data[::-1]
+        if channels == 1:
+            data = data[..., 0]
+        elif self.rawmodes[rawmode][1] is not None:
+            data = data[..., self.rawmodes[rawmode][1]]
+
+        return ArrayReader(data)
+
+
+class TiffReader(RegionReader):
+    """
+    Reads regions from (tiled) TIFF files, by only decoding the tiles that overlap with the region. |br|
+    This reader requires the `tifffile <https://github.com/cgohlke/tifffile>`_ and `zarr <https://zarr.dev>`_ packages.
+
+    Args:
+        path (str or pathlib.Path): Path to the image
+    """
+    def __init__(self, path):
+        if tifffile is None:
+            raise ImportError('TiffReader requires the tifffile and zarr packages')
+
+        self.path = path
+        self.array = zarr.open(tifffile.imread(path, aszarr=True), mode='r')
+        if isinstance(self.array, zarr.Group):
+            # Pyramidal TIFF, use the full resolution level
+            self.array = self.array[0]
+        self.shape = self.array.shape
+
+    def read(self, x0, y0, x1, y1):
+        return np.asarray(self.array[y0:y1, x0:x1])
+
+
+class ImagePyramid(RegionReader):
+    """
+    Multi-resolution pyramid of an image, where each level halves the resolution of the previous one. |br|
+    Levels are only computed the first time they are accessed and regions are read through an LRU cache of tiles,
+    so that revisiting (overlapping) regions does not need to read or decode them again.
+
+    Args:
+        img (RegionReader, str, pathlib.Path, numpy.ndarray or PIL.Image): Full resolution image (see :func:`~ibb.open_region`)
+        tile (int, kw-only): Width and height of the cached tiles; Default **512**
+        max_tiles (int, kw-only): Maximal number of cached tiles; Default **64**
+        cache_dir (str or pathlib.Path, kw-only): Directory to store the computed levels as `.npy` files; Default **None**
+        name (str, kw-only): Name of the image, which is prepended to the files in `cache_dir`; Default **None**
+
+    Note:
+        The pyramid stops at the first level that fits in a single tile.
+
+    Note:
+        If a `cache_dir` is given, the computed levels are stored as `[<name>_]<source>_<level>.npy` and are memory-mapped on later use.
+        The source part is a hash of the path, modification time and size of the image file,
+        or a hash of the pixels for images that are not read from a file,
+        so that levels are recomputed when the image changes and images with the same name do not share levels.
+    """
+    def __init__(self, img, *, tile=512, max_tiles=64, cache_dir=None, name=None):
+        self.base = open_region(img)
+        self.shape = self.base.shape
+        self.tile = tile
+        self.max_tiles = max_tiles
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.name = re.sub(r'[^\w.-]', '_', str(name)) if name is not None else None
+        self.source = None
+
+        self.levels = 1
+        while max(self.level_shape(self.levels - 1)[:2]) > tile:
+            self.levels += 1
+
+        self.readers = {0: self.base}
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        # Computed levels that are not memory-mapped and the cached tiles are kept in memory as well
+        with self.lock:
+            readers = list(self.readers.values())
+            tiles = sum(data.nbytes for data in self.tiles.values())
+        return sum(reader.nbytes for reader in readers) + tiles
+
+    def level_shape(self, level):
+        """ Return the shape of a certain level of the pyramid. """
+        factor = 2 ** level
+        return (ceil(self.shape[0] / factor), ceil(self.shape[1] / factor), *self.shape[2:])
+
+    def select_level(self, width, height, view_width, view_height):
+        """
+        Return the coarsest level at which a region of (width, height) pixels (at full resolution)
+        still has at least the resolution of a (view_width, view_height) view.
+        """
+        if view_width <= 0 or view_height <= 0:
+            return 0
+
+        level = 0
+        while level + 1 < self.levels and width / 2 ** (level + 1) >= view_width and height / 2 ** (level + 1) >= view_height:
+            level += 1
+        return level
+
+    def read(self, x0, y0, x1, y1, level=0):
+        """ Return the region [x0:x1, y0:y1] of the image at a certain level, where the coordinates are expressed in pixels of that level. """
+        height, width = self.level_shape(level)[:2]
+        x0, x1 = max(0, min(x0, width)), max(0, min(x1, width))
+        y0, y1 = max(0, min(y0, height)), max(0, min(y1, height))
+
+        tiles = [
+            (tx, ty, self.get_tile(level, tx, ty))
+            for ty in range(y0 // self.tile, ceil(y1 / self.tile))
+            for tx in range(x0 // self.tile, ceil(x1 / self.tile))
+        ]
+        if len(tiles) == 1 and (x0, y0, x1, y1) == self._tile_bounds(level, *tiles[0][:2]):
+            return tiles[0][2]
+
+        region = None
+        for tx, ty, data in tiles:
+            if region is None:
+                region = np.empty((y1 - y0, x1 - x0, *data.shape[2:]), dtype=data.dtype)
+
+            tx0, ty0 = tx * self.tile, ty * self.tile
+            sx0, sy0 = max(x0, tx0), max(y0, ty0)
+            sx1, sy1 = min(x1, tx0 + data.shape[1]), min(y1, ty0 + data.shape[0])
+            region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = data[sy0 - ty0:sy1 - ty0, sx0 - tx0:sx1 - tx0]
+
+        if region is None:
+            return np.empty((y1 - y0, x1 - x0, *self.shape[2:]), dtype=np.uint8)
+        return region
+
+    def get_tile(self, level, tx, ty):
+        """ Get a tile of a certain level from the cache or read it if necessary. """
+        key = (level, tx, ty)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+
+        data = np.ascontiguousarray(self.get_level(level).read(*self._tile_bounds(level, tx, ty)))
+
+        with self.lock:
+            self.tiles[key] = data
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        return data
+
+    def get_level(self, level):
+        """ Get a :class:`~ibb.RegionReader` for a certain level of the pyramid, which gets computed if necessary. """
+        if not 0 <= level < self.levels:
+            raise IndexError(f'Level should be between 0 and {self.levels - 1} [{level}]')
+
+        with self.lock:
+            if level not in self.readers:
+                self.readers[level] = self._build_level(level)
+            return self.readers[level]
+
+    def _build_level(self, level):
+        shape = self.level_shape(level)
+        path = None
+        if self.cache_dir is not None:
+            if self.source is None:
+                self.source = _source_key(self.base)
+            path = self.cache_dir / f'{self.source}_{level}.npy' if self.name is None else self.cache_dir / f'{self.name}_{self.source}_{level}.npy'
+        if path is not None and path.exists():
+            data = np.load(path, mmap_mode='r')
+            if data.shape == shape:
+                return ArrayReader(data)
+
+        # Reduce the previous level in strips of rows, so that it never needs to be entirely in memory
+        if level - 1 not in self.readers:
+            self.readers[level - 1] = self._build_level(level - 1)
+        previous = self.readers[level - 1]
+        if path is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        data = None
+
+        prev_height, prev_width = previous.shape[:2]
+        strip = 2 * self.tile
+        for y in range(0, prev_height, strip):
+            rows = _reduce(previous.read(0, y, prev_width, min(y + strip, prev_height)))
+            if data is None:
+                if path is not None:
+                    data = np.lib.format.open_memmap(path, mode='w+', dtype=rows.dtype, shape=shape)
+                else:
+                    data = np.empty(shape, dtype=rows.dtype)
+            data[y // 2:y // 2 + rows.shape[0]] = rows
+
+        if path is not None:
+            data.flush()
+            data = np.load(path, mmap_mode='r')
+        return ArrayReader(data)
+
+    def _tile_bounds(self, level, tx, ty):
+        height, width = self.level_shape(level)[:2]
+        x0, y0 = tx * self.tile, ty * self.tile
+        return x0, y0, min(x0 + self.tile, width), min(y0 + self.tile, height)
+
+
+def _source_key(reader):
+    """ Return a hash that identifies the image of a reader, based on the file it reads or otherwise on its pixels. """
+    path, view = getattr(reader, 'path', None), ''
+    array = getattr(reader, 'array', None)
+    if path is None and isinstance(array, np.ndarray):
+        base = array
+        while isinstance(base.base, np.ndarray):
+            base = base.base
+        if isinstance(base, np.memmap) and base.filename is not None:
+            # Arrays can be a view on part of the file (eg. one image of a stack)
+            path = base.filename
+            start = array.__array_interface__['data'][0] - base.__array_interface__['data'][0]
+            view = f'|{base.offset + start}|{array.shape}|{array.strides}|{array.dtype.str}'
+
+    if path is not None:
+        path = Path(path).resolve()
+        stat = path.stat()
+        key = f'{path}|{stat.st_mtime_ns}|{stat.st_size}{view}'.encode()
+        return hashlib.sha1(key).hexdigest()[:16]
+
+    # Hash the pixels in strips of rows, so that the image never needs to be entirely in memory
+    digest = hashlib.sha1(str(reader.shape).encode())
+    height, width = reader.shape[:2]
+    for y in range(0, height, 1024):
+        rows = np.ascontiguousarray(reader.read(0, y, width, min(y + 1024, height)))
+        digest.update(rows.dtype.str.encode())
+        digest.update(rows.data)
+    return digest.hexdigest()[:16]
+
+
+def _reduce(img):
+    """ Halve the resolution of an image by averaging blocks of 2x2 pixels (odd borders are padded by repeating the last pixel). """
+    height, width = img.shape[:2]
+    pad = [(0, height % 2), (0, width % 2)] + [(0, 0)] * (img.ndim - 2)
+    if height % 2 or width % 2:
+        img = np.pad(img, pad, mode='edge')
+
+    blocks = img.reshape(img.shape[0] // 2, 2, img.shape[1] // 2, 2, *img.shape[2:])
+    reduced = blocks.mean(axis=(1, 3), dtype=np.float32)
+    if np.issubdtype(img.dtype, np.integer):
+        reduced = np.rint(reduced)
+    return reduced.astype(img.dtype)
+
+
+def open_region(img):
+    """
+    Wrap an image in a :class:`~ibb.RegionReader`.
+
+    Args:
+        img (RegionReader, str, pathlib.Path, numpy.ndarray or PIL.Image): Image or path to the image
+
+    Note:
+        Paths are opened in the following way:
+        - *.npy*        : Memory-mapped with numpy
+        - *.tif, .tiff* : Read tile by tile with :class:`~ibb.TiffReader` if tifffile and zarr are installed
+        - *other*       : Memory-mapped if the file is uncompressed, otherwise decoded by PIL on the first read
+    """
+    if isinstance(img, RegionReader):
+        return img
+
+    if isinstance(img, (str, Path)):
+        suffix = Path(img).suffix.lower()
+        if suffix == '.npy':
+            return ArrayReader(np.load(img, mmap_mode='r'))
+
+        reader = PILReader(img)
+        if reader.reader is None and suffix in ('.tif', '.tiff') and tifffile is not None:
+            return TiffReader(img)
+        return reader
+
+    return ArrayReader(np.asarray(img))
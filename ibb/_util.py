@@ -1,4 +1,21 @@
+import mmap
+from pathlib import Path
 import numpy as np
+import pandas as pd
+from PIL import Image
+
+try:
+    import pygeos
+except ImportError:
+    pygeos = None
+
+try:
+    import shapely
+    if not hasattr(shapely, 'get_coordinates'):
+        # Vectorized functions are only available from shapely 2.0 onwards
+        shapely = None
+except ImportError:
+    shapely = None
 
 
 def cast_alpha(alpha):
@@ -21,6 +38,22 @@ def cast_alpha(alpha):
         raise TypeError(f'Alpha should be a HEX string, integer or float [{type(alpha)}]')
 
 
+def read_image(path):
+    """ Read an image from disk, where `.npy` files are memory-mapped instead of being decoded in memory. """
+    if Path(path).suffix.lower() == '.npy':
+        return np.load(path, mmap_mode='r')
+    return np.asarray(Image.open(path))
+
+
+def is_memmap(array):
+    """ Check whether a numpy array is a view on a memory-mapped file (its pages live in the OS cache and not on the heap). """
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+
 def box_to_coords(row):
     return np.array([
         [row.x_top_left, row.y_top_left],
@@ -34,3 +67,119 @@ def mask_to_coords(row):
     if hasattr(row.segmentation, 'exterior'):
         return np.array(row.segmentation.exterior.coords)
     return np.array(row.segmentation.coords)
+
+
+def boxes_to_coords(boxes):
+    """ Vectorized :func:`box_to_coords`, which returns a Series with a (4, 2) array of corners for each row. """
+    x0 = boxes['x_top_left'].to_numpy(dtype=float)
+    y0 = boxes['y_top_left'].to_numpy(dtype=float)
+    x1 = x0 + boxes['width'].to_numpy(dtype=float)
+    y1 = y0 + boxes['height'].to_numpy(dtype=float)
+
+    coords = np.stack((
+        np.stack((x0, y0), axis=-1),
+        np.stack((x1, y0), axis=-1),
+        np.stack((x1, y1), axis=-1),
+        np.stack((x0, y1), axis=-1),
+    ), axis=1)
+
+    return pd.Series(list(coords), index=boxes.index, dtype=object)
+
+
+def masks_to_coords(boxes):
+    """ Vectorized :func:`mask_to_coords`, which pulls the coordinates of all pygeos/shapely geometries in bulk. """
+    geometries = np.asarray(boxes['segmentation'], dtype=object)
+    if len(geometries) == 0:
+        return pd.Series([], index=boxes.index, dtype=object)
+
+    lib = get_geometry_lib(geometries)
+    if lib is None:
+        return pd.Series([mask_to_coords(row) for row in boxes.itertuples()], index=boxes.index, dtype=object)
+
+    # Replace polygons by their exterior ring
+    rings = geometries.copy()
+    polygons = lib.get_type_id(geometries) == 3
+    rings[polygons] = lib.get_exterior_ring(geometries[polygons])
+
+    coords, index = lib.get_coordinates(rings, return_index=True)
+    coords = np.split(coords, np.searchsorted(index, np.arange(1, len(rings))))
+
+    return pd.Series(coords, index=boxes.index, dtype=object)
+
+
+def simplify_coords(coords, offsets, tolerance, min_points=4):
+    """
+    Vectorized Douglas-Peucker simplification of packed polygons (see :func:`~ibb.widgets._image_canvas._pack_coords`). |br|
+    All polygons are simplified together, by splitting every segment whose farthest point lies further than `tolerance` in each iteration.
+
+    Polygons that would keep fewer than `min_points` points are left untouched,
+    so that small objects do not collapse into lines.
+
+    Returns:
+        tuple: Simplified coordinates and offsets
+    """
+    num = len(offsets) - 1
+    starts = offsets[:-1].astype(np.int64)
+    ends = offsets[1:].astype(np.int64) - 1
+    xy = np.asarray(coords, dtype=np.float64)
+
+    keep = np.zeros(len(xy), dtype=bool)
+    valid = ends >= starts
+    keep[starts[valid]] = True
+    keep[ends[valid]] = True
+
+    seg_start, seg_end = starts[valid], ends[valid]
+    while len(seg_start):
+        # Only segments with points in between them need to be checked
+        lengths = seg_end - seg_start - 1
+        inner = lengths > 0
+        seg_start, seg_end, lengths = seg_start[inner], seg_end[inner], lengths[inner]
+        if len(seg_start) == 0:
+            break
+
+        seg_offsets = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=seg_offsets[1:])
+        seg_id = np.repeat(np.arange(len(lengths)), lengths)
+        idx = np.arange(lengths.sum()) - seg_offsets[seg_id] + seg_start[seg_id] + 1
+
+        # Distance to the segment line (or to the start point for closed rings)
+        a, b, p = xy[seg_start][seg_id], xy[seg_end][seg_id], xy[idx]
+        ab, ap = b - a, p - a
+        norm = np.hypot(ab[:, 0], ab[:, 1])
+        cross = np.abs(ab[:, 0] * ap[:, 1] - ab[:, 1] * ap[:, 0])
+        dist = np.where(norm > 0, cross / np.where(norm > 0, norm, 1), np.hypot(ap[:, 0], ap[:, 1]))
+
+        # Split segments at their farthest point
+        max_dist = np.maximum.reduceat(dist, seg_offsets)
+        farthest = np.flatnonzero(dist == max_dist[seg_id])
+        segments, first = np.unique(seg_id[farthest], return_index=True)
+        split = max_dist[segments] > tolerance
+        segments, split_idx = segments[split], idx[farthest[first[split]]]
+        keep[split_idx] = True
+
+        seg_start, seg_end = np.concatenate((seg_start[segments], split_idx)), np.concatenate((split_idx, seg_end[segments]))
+
+    # Keep small polygons as is
+    kept = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum(keep, out=kept[1:])
+    counts = kept[ends + 1] - kept[starts]
+    small = counts < np.minimum(min_points, ends - starts + 1)
+    if small.any():
+        lengths = ends[small] - starts[small] + 1
+        keep[np.repeat(starts[small], lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)] = True
+        counts[small] = lengths
+
+    new_offsets = np.zeros(num + 1, dtype=offsets.dtype)
+    np.cumsum(counts, out=new_offsets[1:])
+    return np.ascontiguousarray(coords[keep]), new_offsets
+
+
+def get_geometry_lib(geometries):
+    """ Return the vectorized geometry library (pygeos or shapely) of the given geometry array or None if it is not supported. """
+    if len(geometries) == 0:
+        return None
+    if pygeos is not None and isinstance(geometries[0], pygeos.Geometry):
+        return pygeos
+    if shapely is not None and isinstance(geometries[0], shapely.Geometry):
+        return shapely
+    return None
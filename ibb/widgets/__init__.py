@@ -4,7 +4,7 @@ from ._torch_viewer import TorchViewer
 from ._cutout_viewer import CutoutViewer
 from ._patch_viewer import PatchViewer
 
-from ._image_canvas import ImageCanvas
+from ._image_canvas import ImageCanvas, EncodedImage
 from ._unlink_box import UnlinkBox
 from ._repeat_button import RepeatButton
 from ._image_controls import ImageControls
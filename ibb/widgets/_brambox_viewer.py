@@ -1,10 +1,10 @@
+from collections import OrderedDict
 from pathlib import Path
 import numpy as np
-from PIL import Image
 import ipywidgets
 from brambox.util._visual import setup_boxes
 from ._viewer import Viewer
-from .._util import cast_alpha, box_to_coords, mask_to_coords
+from .._util import cast_alpha, boxes_to_coords, masks_to_coords, read_image
 
 __all__ = ['BramboxViewer']
 
@@ -15,7 +15,7 @@ class BramboxViewer(Viewer):
     Its arguments work a lot like :class:`brambox.util.BoxDrawer`.
 
     Args:
-        images (callable or dict-like object):
+        images (callable, dict-like object, numpy.ndarray, str or pathlib.Path):
             A way to get the image or path to the image from the image labels in the dataframe
         boxes (pandas.DataFrame):
             Bounding boxes to draw
@@ -27,6 +27,8 @@ class BramboxViewer(Viewer):
             Thickness of the border of the bounding boxes; Default **3**
         alpha (pandas.Series):
             Alpha fill value of the bounding boxes; Default **00**
+        lazy (bool or int, kw-only):
+            Only compute polygon coordinates for the images that are shown and cache them for the last `lazy` images (True means 16); Default **False**
         **kwargs (dict):
             Extra keyword arguments that will be passed to :class:`~ibb.widgets.Viewer`
 
@@ -37,14 +39,20 @@ class BramboxViewer(Viewer):
         Otherwise the image or path is retrieved as:
         >>> image = images[image_label]
 
+        Finally, `images` can also be an (N, H, W[, C]) numpy array or the path to a `.npy` file containing such an array,
+        in which case the images are retrieved with the index of their label in the image categories of the dataframe.
+        `.npy` files are memory-mapped, so that only the images that are viewed get read from disk.
+
     Note:
         The `label`, `color`, `size` and `alpha` arguments can also be tacked on to the `boxes` dataframe as columns.
         They can also be a single value, which will then be used for each bounding box. |br|
         Basically, as long as you can assign the value as a new column to the dataframe, it will work.
     """
-    def __init__(self, images, boxes, label=True, color=None, size=3, alpha=0, **kwargs):
+    def __init__(self, images, boxes, label=True, color=None, size=3, alpha=0, *, lazy=False, **kwargs):
         # Metadata
-        self.images = images
+        self.images = read_image(images) if isinstance(images, (str, Path)) else images
+        self.lazy = 16 if lazy is True else int(lazy)
+        self.coords_cache = OrderedDict()
         self.info = False
         self.draw_box_max = 3 if 'segmentation' in boxes.columns else 2
         self.draw_box = self.draw_box_max - 1
@@ -61,9 +69,13 @@ class BramboxViewer(Viewer):
         )
         self.boxes.color = 'rgb' + self.boxes.color.astype(str)
         self.boxes['alpha'] = self.boxes['alpha'].apply(cast_alpha)
-        self.boxes['boxcoords'] = self.boxes.apply(box_to_coords, axis=1)
-        if self.draw_box_max == 3:
-            self.boxes['maskcoords'] = self.boxes.apply(mask_to_coords, axis=1)
+        if not self.lazy:
+            self.boxes = self.add_coords(self.boxes)
+
+        # Positional index of the rows of each image (stable sort on category codes, so rows keep their original order)
+        codes = self.boxes.image.cat.codes.values
+        self.image_order = np.argsort(codes, kind='stable')
+        self.image_offsets = np.searchsorted(codes[self.image_order], np.arange(len(self.boxes.image.cat.categories) + 1))
 
         # ImageCanvas arguments
         if 'hover_style' not in kwargs:
@@ -131,15 +143,54 @@ class BramboxViewer(Viewer):
 
         return [w_conf_slider]
 
-    def get_data(self, index):
-        label = self.boxes.image.cat.categories[index]
-        boxes = self.boxes[self.boxes.image == label].copy()
+    def add_coords(self, boxes):
+        """ Return the boxes with the 'boxcoords' and 'maskcoords' polygon columns. """
+        if 'boxcoords' in boxes:
+            return boxes
+
+        coords = {'boxcoords': boxes_to_coords(boxes)}
+        if self.draw_box_max == 3:
+            coords['maskcoords'] = masks_to_coords(boxes)
+
+        return boxes.assign(**coords)
+
+    def get_boxes(self, index):
+        """ Get the boxes of the image with the given category index, without scanning the entire dataframe. """
+        if index in self.coords_cache:
+            self.coords_cache.move_to_end(index)
+            return self.coords_cache[index]
+
+        start, end = self.image_offsets[index], self.image_offsets[index + 1]
+        boxes = self.boxes.iloc[self.image_order[start:end]]
+
+        if self.lazy:
+            boxes = self.add_coords(boxes)
+            self.coords_cache[index] = boxes
+            if len(self.coords_cache) > self.lazy:
+                self.coords_cache.popitem(last=False)
+
+        return boxes
+
+    def image_key(self, index):
+        return self.boxes.image.cat.categories[index]
 
-        img = self.images(label) if callable(self.images) else self.images[label]
+    def image_source(self, key):
+        """ Get the image or path to the image for a certain image label. """
+        if isinstance(self.images, np.ndarray):
+            return self.images[self.boxes.image.cat.categories.get_loc(key)]
+        return self.images(key) if callable(self.images) else self.images[key]
+
+    def load_image(self, key):
+        img = self.image_source(key)
         if isinstance(img, (str, Path)):
-            img = np.asarray(Image.open(img))
+            return self.read_image(img)
         else:
-            img = np.asarray(img)
+            return np.asarray(img)
+
+    def get_data(self, index):
+        label = self.boxes.image.cat.categories[index]
+        boxes = self.get_boxes(index)
+        img = self.get_image(label)
 
         return label, img, boxes
 
@@ -147,7 +198,7 @@ class BramboxViewer(Viewer):
         if self.draw_box:
             bb = boxes[['color', 'size', 'alpha']].copy()
             coord_col = 'maskcoords' if self.draw_box == 2 else 'boxcoords'
-            bb['coords'] = boxes[coord_col].apply(lambda c: c.tolist())
+            bb['coords'] = boxes[coord_col]
             bb['label'] = boxes['class_label']
             if 'confidence' in boxes:
                 bb['label'] += boxes['confidence'].apply(lambda num: f' ({num:.2%})')
@@ -155,16 +206,27 @@ class BramboxViewer(Viewer):
         else:
             self.main[0].polygons = None
 
-    def on_index(self, change):
-        """ """
-        self.header[0].value, self.main[0].image, self.current_all_boxes = self.get_data(change['new'])
-
+    def filter_boxes(self):
+        """ Compute which of the boxes of the current image pass the confidence threshold. """
         if self.conf_enabled:
-            self.current_boxes = self.current_all_boxes[self.current_all_boxes['confidence'] >= self.side[0].value]
+            self.current_visible = (self.current_all_boxes['confidence'] >= self.side[0].value).to_numpy()
+            self.current_boxes = self.current_all_boxes[self.current_visible]
         else:
+            self.current_visible = None
             self.current_boxes = self.current_all_boxes
 
-        self.draw_boxes(self.current_boxes.copy())
+    def on_index(self, change):
+        """ """
+        self.header[0].value, self.main[0].image, self.current_all_boxes = self.get_data(change['new'])
+        self.on_overlay()
+
+    def on_overlay(self):
+        """ """
+        # All boxes are sent, so that the threshold can be changed by only sending a new visibility mask
+        with self.main[0].hold_sync():
+            self.filter_boxes()
+            self.draw_boxes(self.current_all_boxes.copy())
+            self.main[0].visible = self.current_visible
 
     def on_save(self, btn):
         self.main[0].save = True
@@ -172,7 +234,7 @@ class BramboxViewer(Viewer):
     def on_box(self, btn):
         self.draw_box = (self.draw_box + 1) % self.draw_box_max
         btn.tooltip = f'toggle none/box/mask [{self.draw_box_text[self.draw_box]}]'
-        self.redraw()
+        self.redraw(image=False)
 
     def on_info(self, btn):
         self.info = not self.info
@@ -188,7 +250,7 @@ class BramboxViewer(Viewer):
             self.main[-1].value = ''
             return
 
-        self.clicked = self.current_boxes.iloc[clicked]
+        self.clicked = self.current_all_boxes.iloc[clicked]
         columns = (
             sorted(self.clicked.index.difference([
                 'image',
@@ -222,23 +284,33 @@ class BramboxViewer(Viewer):
         # Option 1 : Same object (keep clicked when toggling box/mask)
         index = self.clicked.name
         if index in self.current_boxes.index:
-            self.main[0].clicked = self.current_boxes.index.get_loc(index)
-            self.clicked = self.current_boxes.loc[index]
+            self.main[0].clicked = self.current_all_boxes.index.get_loc(index)
+            self.clicked = self.current_all_boxes.loc[index]
             return
 
         # Option 2 : Object with same class and id (useful in tracking context)
         label = self.clicked['class_label']
         id = self.clicked['id']
-        new_clicked = (self.current_boxes['class_label'] == label) & (self.current_boxes['id'] == id)
+        new_clicked = (self.current_all_boxes['class_label'] == label) & (self.current_all_boxes['id'] == id)
+        if self.current_visible is not None:
+            new_clicked &= self.current_visible
 
         if new_clicked.any():
             index = int(new_clicked.values.argmax())
             self.main[0].clicked = index
-            self.clicked = self.current_boxes.iloc[index]
+            self.clicked = self.current_all_boxes.iloc[index]
             return
 
         # Default: Reset clicked
         self.clicked = None
 
     def on_threshold(self, change):
-        self.redraw()
+        # Fast path: only send a new visibility mask for the polygons that were already sent
+        self.filter_boxes()
+        with self.main[0].hold_sync():
+            self.main[0].visible = self.current_visible
+
+            # Reset clicked if it got hidden by the threshold
+            if self.clicked is not None and self.clicked.name not in self.current_boxes.index:
+                self.clicked = None
+                self.main[0].clicked = None
@@ -1,7 +1,4 @@
 from math import floor, ceil
-from pathlib import Path
-import numpy as np
-from PIL import Image
 from ._brambox_viewer import BramboxViewer
 
 __all__ = ['CutoutViewer']
@@ -14,7 +11,7 @@ class CutoutViewer(BramboxViewer):
     The main difference with :class:`~ibb.BramboxViewer` is that each polygon is shown as a separate cutout.
 
     Args:
-        images (callable or dict-like object):
+        images (callable, dict-like object, numpy.ndarray, str or pathlib.Path):
             A way to get the image or path to the image from the image labels in the dataframe
         boxes (pandas.DataFrame):
             Bounding boxes to draw
@@ -38,6 +35,9 @@ class CutoutViewer(BramboxViewer):
         Otherwise the image or path is retrieved as:
         >>> image = images[image_label]
 
+        Finally, `images` can also be an (N, H, W[, C]) numpy array or the path to a `.npy` file containing such an array,
+        in which case the images are retrieved with the index of their label in the image categories of the dataframe.
+
     Note:
         The padding property can be one of 4 possible types:
         - *int*             : A fixed pixel padding is added to each side.
@@ -58,8 +58,6 @@ class CutoutViewer(BramboxViewer):
         else:
             self.pad = pad
 
-        self.cache = {'label': None}
-
         if 'total' not in kwargs:
             kwargs['total'] = len(boxes)
 
@@ -78,23 +76,14 @@ class CutoutViewer(BramboxViewer):
         self.conf_enabled = False
         return []
 
+    def image_key(self, index):
+        return self.boxes['image'].iat[index]
+
     def get_data(self, index):
         # Get data
         box = self.boxes.iloc[index]
         label = box['image']
-        if self.cache['label'] == label:
-            img = self.cache['img']
-        else:
-            img = self.images(label) if callable(self.images) else self.images[label]
-            if isinstance(img, (str, Path)):
-                img = np.asarray(Image.open(img))
-            else:
-                img = np.asarray(img)
-
-            self.cache = {
-                'label': label,
-                'img': img,
-            }
+        img = self.get_image(label)
 
         # Compute crop
         if isinstance(self.pad, float):
@@ -108,16 +97,16 @@ class CutoutViewer(BramboxViewer):
         y0 = floor(max(0, box.y_top_left - pad_y))
         x1 = ceil(min(img.shape[1], box.x_top_left + box.width + pad_x))
         y1 = ceil(min(img.shape[0], box.y_top_left + box.height + pad_y))
-        self.cache['pad'] = [x0, y0]
+        self.offset = [x0, y0]
 
         # Set self.clicked to automatically click on new cutout
         self.clicked = box
 
-        return label, img[y0:y1, x0:x1], self.boxes.iloc[index:index + 1]
+        return label, img[y0:y1, x0:x1], self.add_coords(self.boxes.iloc[index:index + 1])
 
     def draw_boxes(self, boxes):
-        boxes['boxcoords'] = boxes['boxcoords'].apply(lambda c: c - self.cache['pad'])
+        boxes['boxcoords'] = boxes['boxcoords'].apply(lambda c: c - self.offset)
         if 'maskcoords' in boxes:
-            boxes['maskcoords'] = boxes['maskcoords'].apply(lambda c: c - self.cache['pad'])
+            boxes['maskcoords'] = boxes['maskcoords'].apply(lambda c: c - self.offset)
 
         super().draw_boxes(boxes)
@@ -1,19 +1,150 @@
+import hashlib
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
 import traitlets
 import traittypes
 import ipywidgets
 import numpy as np
+from PIL import Image
 from .._frontend import module_name, module_version
-from .._util import cast_alpha
+from .._util import cast_alpha, simplify_coords
 
-__all__ = ['ImageCanvas']
+__all__ = ['ImageCanvas', 'EncodedImage']
+
+ENCODINGS = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+class EncodedImage:
+    """
+    Already encoded image data (eg. the bytes of a JPEG file),
+    which the :class:`~ibb.widgets.ImageCanvas` forwards to the browser without ever decoding it in Python.
+
+    Args:
+        data (bytes): Encoded image data
+        shape (tuple of int): Height and width of the image
+        format (str): MIME type of the data (eg. 'image/jpeg')
+    """
+    browser_formats = {
+        'JPEG': 'image/jpeg',
+        'PNG': 'image/png',
+        'WEBP': 'image/webp',
+        'GIF': 'image/gif',
+        'BMP': 'image/bmp',
+    }
+
+    def __init__(self, data, shape, format):
+        self.data = data
+        self.shape = tuple(shape[:2])
+        self.format = format
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Read the encoded bytes of an image file. |br|
+        Only the header of the file gets parsed to get the image size and format.
+
+        Returns:
+            EncodedImage or None: Encoded image or None if the file format cannot be decoded by browsers
+        """
+        with Image.open(path) as img:
+            format = cls.browser_formats.get(img.format)
+            width, height = img.size
+
+        if format is None:
+            return None
+        return cls(Path(path).read_bytes(), (height, width), format)
 
 
 def array_to_binary(ar, obj=None):
-    if ar is not None:
-        mv = memoryview(ar)
-        return {'data': mv, 'shape': ar.shape[:-1]}
-    else:
+    if ar is None:
+        return None
+
+    if isinstance(ar, EncodedImage):
+        return {'data': memoryview(ar.data), 'shape': ar.shape, 'source_shape': ar.shape, 'format': ar.format}
+
+    source_shape = ar.shape[:2]
+    if obj is not None and obj.downscale:
+        ar = obj._downscale_image(ar)
+
+    if obj is not None and obj.encoding != 'raw':
+        return {'data': memoryview(obj._encode_image(ar)), 'shape': ar.shape[:2], 'source_shape': source_shape, 'format': ENCODINGS[obj.encoding]}
+
+    # Grayscale and RGB data is sent as is and gets expanded to RGBA in the browser
+    channels = ar.shape[2] if ar.ndim == 3 else 1
+    mv = memoryview(np.ascontiguousarray(ar))
+    return {'data': mv, 'shape': (*ar.shape[:2], channels), 'source_shape': source_shape}
+
+
+def polygons_to_binary(polygons, obj=None):
+    """
+    Pack the polygons in flat columnar buffers, so they can be sent as binary comm buffers instead of JSON.
+
+    - coords: float32 buffer with all X,Y coordinates
+    - offsets: uint32 buffer with the start of each polygon (in number of coordinates), plus the total number of coordinates
+    - alt_coords/alt_offsets: same for the alternative coordinates (only if any polygon has them)
+    - palette: list of unique colors ('' means default color)
+    - color: uint16 buffer with the palette index of each polygon
+    - size: float32 buffer with the border size of each polygon (0 means default size)
+    - alpha: int16 buffer with the fill alpha of each polygon (-1 means default alpha)
+    - label: list with the label of each polygon
+    """
+    if polygons is None:
+        return None
+
+    num = len(polygons)
+    coords, offsets = _pack_coords([p['coords'] for p in polygons])
+    if obj is not None and obj.simplify > 0:
+        coords, offsets = obj._simplify_coords(coords, offsets)
+
+    palette = {'': 0}
+    color = np.fromiter((palette.setdefault(p.get('color') or '', len(palette)) for p in polygons), dtype=np.uint16, count=num)
+    size = np.fromiter((p.get('size') or 0 for p in polygons), dtype=np.float32, count=num)
+    alpha = np.fromiter((int(p['alpha'], 16) if p.get('alpha') else -1 for p in polygons), dtype=np.int16, count=num)
+
+    data = {
+        'coords': memoryview(coords),
+        'offsets': memoryview(offsets),
+        'palette': list(palette),
+        'color': memoryview(color),
+        'size': memoryview(size),
+        'alpha': memoryview(alpha),
+        'label': [p.get('label') for p in polygons],
+    }
+
+    if any('alt_coords' in p for p in polygons):
+        alt_coords, alt_offsets = _pack_coords([p.get('alt_coords', ()) for p in polygons])
+        if obj is not None and obj.simplify > 0:
+            alt_coords, alt_offsets = obj._simplify_coords(alt_coords, alt_offsets)
+        data['alt_coords'] = memoryview(alt_coords)
+        data['alt_offsets'] = memoryview(alt_offsets)
+
+    return data
+
+
+def _pack_coords(coords):
+    """ Concatenate a list of coordinate arrays into a flat float32 buffer and a uint32 offsets buffer. """
+    coords = [np.asarray(c, dtype=np.float32).reshape(-1, 2) for c in coords]
+    offsets = np.zeros(len(coords) + 1, dtype=np.uint32)
+    np.cumsum([len(c) for c in coords], out=offsets[1:])
+
+    if len(coords) == 0:
+        return np.empty((0, 2), dtype=np.float32), offsets
+    return np.concatenate(coords), offsets
+
+
+def mask_to_binary(mask, obj=None):
+    if mask is None:
         return None
+    return {'data': memoryview(np.ascontiguousarray(mask, dtype=np.uint8)), 'shape': mask.shape}
 
 
 @ipywidgets.register
@@ -32,13 +163,49 @@ class ImageCanvas(ipywidgets.DOMWidget):
         size (Integer): Default border thickness for the polygons; Default **2**
         hover_style (Dict): Default hover style (can contain color,alpha and/or size properties); Default **None**
         click_style (Dict): Default click style (can contain color,alpha and/or size properties); Default **None**
+        downscale (Boolean): Whether to resample the image to the displayed size before sending it to the browser; Default **False**
+        encoding (String): How to encode the image before sending it to the browser ('raw', 'png', 'jpeg' or 'webp'); Default **raw**
+        quality (Integer): Quality setting for the 'jpeg' and 'webp' encodings (0-100); Default **85**
+        sync_hover (Boolean): Whether to send the hovered polygon to the kernel (disable to only show it in the browser); Default **True**
+        sync_rate (Float): Maximal number of hovered updates per second that get sent to the kernel (0 means no limit); Default **20**
+        offscreen (Boolean): Whether to render the canvas in a Web Worker, so heavy frames do not block the notebook interface; Default **False**
+        simplify (Float): Tolerance in screen pixels to simplify the polygons with before sending them (0 disables simplification); Default **0**
 
     Attributes:
-        image (numpy.ndarray): Image data in HWC order. See :meth:`ImageCanvas.validate_image` for more information
+        image (numpy.ndarray or EncodedImage): Image data in HWC order. See :meth:`ImageCanvas.validate_image` for more information
         polygons (dict): polygons to draw. See :meth:`ImageCanvas.validate_polygons` for more information
+        visible (numpy.ndarray): Boolean mask with the polygons to show (None shows all polygons). See :meth:`ImageCanvas.validate_visible` for more information
+        alt_coords (Bool): Whether to draw the alternative coordinates of the polygons (if they have any)
         clicked (Integer): Index of the clicked rectangle
         hovered (Integer): Index of the hovered rectangle
         save (Bool): Save image and polygons
+        view_width (Integer): Width of the canvas in the browser
+        view_height (Integer): Height of the canvas in the browser
+
+    Note:
+        When `downscale` is enabled, only the transmitted image is resampled.
+        The `image` attribute keeps the full resolution data and polygons should still be given in full resolution image coordinates.
+        Whenever the canvas gets resized in the browser, the image is resampled and sent again.
+
+    Note:
+        Images can also be given as an :class:`~ibb.widgets.EncodedImage`, which gets sent to the browser as is.
+        This bypasses the `downscale` and `encoding` settings.
+
+    Note:
+        The `hovered` and `clicked` attributes are only sent to the kernel when their value changes.
+        Hovered updates are additionally rate limited by `sync_rate`, but the last hovered polygon is always sent.
+        If nothing in the kernel needs to react to hovering, you can disable `sync_hover` and the hover effect will be drawn without any kernel traffic.
+
+    Note:
+        With `offscreen` enabled, the image and polygons are copied to a Web Worker,
+        which draws them on an OffscreenCanvas and also performs the hit testing for hovering and clicking. |br|
+        Browsers that do not support OffscreenCanvas or refuse to start the worker script (eg. when the widgets are loaded from a CDN) fall back to rendering on the main thread.
+
+    Note:
+        When `simplify` is set, the polygons are simplified with the Douglas-Peucker algorithm before they are sent to the browser.
+        The tolerance gets converted to image pixels with the current display scale and is rounded down to a power of 2,
+        so that the polygons only need to be simplified (and sent) again when the canvas size changes considerably. |br|
+        The simplified polygons are cached, so that revisiting an image or only changing its visible polygons does not simplify them again.
     """
     _model_module = traitlets.Unicode(module_name).tag(sync=True)
     _model_name = traitlets.Unicode('ImageCanvasModel').tag(sync=True)
@@ -56,13 +223,28 @@ class ImageCanvas(ipywidgets.DOMWidget):
     size = traitlets.Int(2).tag(sync=True)
     hover_style = traitlets.Dict(default_value=None, allow_none=True).tag(sync=True)
     click_style = traitlets.Dict(default_value=None, allow_none=True).tag(sync=True)
+    downscale = traitlets.Bool(False)
+    encoding = traitlets.Enum(tuple(['raw', *ENCODINGS]), default_value='raw')
+    quality = traitlets.Int(85)
+    sync_hover = traitlets.Bool(True).tag(sync=True)
+    sync_rate = traitlets.Float(20).tag(sync=True)
+    offscreen = traitlets.Bool(False).tag(sync=True)
+    simplify = traitlets.Float(0)
 
     # Attributes
-    image = traittypes.Array(None, allow_none=True).tag(sync=True, to_json=array_to_binary)
-    polygons = traitlets.List(None, allow_none=True).tag(sync=True)
+    image = traitlets.Union(
+        [traitlets.Instance(EncodedImage), traittypes.Array()],
+        default_value=None,
+        allow_none=True,
+    ).tag(sync=True, to_json=array_to_binary)
+    polygons = traitlets.List(None, allow_none=True).tag(sync=True, to_json=polygons_to_binary)
+    visible = traittypes.Array(None, allow_none=True).tag(sync=True, to_json=mask_to_binary)
+    alt_coords = traitlets.Bool(False).tag(sync=True)
     clicked = traitlets.Int(None, allow_none=True).tag(sync=True)
     hovered = traitlets.Int(None, allow_none=True).tag(sync=True)
     save = traitlets.Bool(False).tag(sync=True)
+    view_width = traitlets.Int(0).tag(sync=True)
+    view_height = traitlets.Int(0).tag(sync=True)
 
     def __init__(self, **kwargs):
         for attr in ('color', 'alpha', 'size'):
@@ -81,20 +263,28 @@ class ImageCanvas(ipywidgets.DOMWidget):
             except Exception as err:
                 raise ValueError(f'Wrong value in click_style: {err}') from err
 
+        self._sent_size = None
+        self._sent_tolerance = None
+        self._simplify_cache = OrderedDict()
+        self.disk_cache = None
         super().__init__(**kwargs)
 
     @traitlets.validate('image')
     def validate_image(self, proposal):
         """
-        Validate correct image shape and dtype and cast to RGBA uint8 (0-255)
+        Validate correct image shape and dtype and cast to uint8 (0-255)
 
         Valid data types:
+            - EncodedImage (sent as is)
             - RGBA uint8 (0-255)
             - RGB uint8 (0-255)
             - Grayscale uint8 (0-255)
             - RGBA float (0-1)
             - RGB float (0-1)
             - Grayscale float (0-1)
+
+        Note:
+            Grayscale and RGB images are not expanded to RGBA, but are sent as is and get converted in the browser.
         """
         img = proposal['value']
         if self.auto_clear:
@@ -102,52 +292,127 @@ class ImageCanvas(ipywidgets.DOMWidget):
             self.hovered = None
             self.clicked = None
 
-        if img is None:
+        if img is None or isinstance(img, EncodedImage):
             return img
         if not isinstance(img, np.ndarray):
             raise TypeError(f'image should by a numpy array or None [{type(img)}]')
+        if img.ndim != 2 and (img.ndim != 3 or img.shape[2] not in (3, 4)):
+            raise ValueError(f'Image shape not supported [{img.shape}, {img.dtype}]')
 
         if img.dtype == np.uint8:
-            if img.ndim == 2:
-                img = np.dstack((img, img, img, 255 * np.ones(img.shape, dtype=np.uint8)))
-                return img
-            elif img.ndim == 3 and img.shape[2] in (3, 4):
-                if img.shape[2] == 3:
-                    img = np.dstack((img, 255 * np.ones(img.shape[:-1], dtype=np.uint8)))
-                return img
-            else:
-                raise ValueError(f'Image shape not supported [{img.shape}, {img.dtype}]')
+            return img
         elif img.dtype in (np.float32, np.float64):
-            if img.ndim == 2:
-                img = np.dstack((img, img, img, np.ones(img.shape, dtype=img.dtype)))
-            elif img.ndim == 3 and img.shape[2] == 3:
-                img = np.dstack((img, np.ones(img.shape[:-1], dtype=img.dtype)))
-
-            if img.ndim == 3 and img.shape[2] == 4:
-                return (img * 255).astype(np.uint8)
-            else:
-                raise ValueError(f'Image shape not supported [{img.shape}, {img.dtype}]')
+            # Single pass conversion, without intermediate float arrays
+            out = np.empty(img.shape, dtype=np.uint8)
+            np.multiply(img, 255, out=out, casting='unsafe')
+            return out
         else:
             raise TypeError(f'Image type not supported [{img.dtype}]')
 
+    @traitlets.observe('view_width', 'view_height')
+    def _observe_view_size(self, change):
+        """ Resend the image if the canvas size changes the resolution at which it gets sent. """
+        img = self.image
+        if self.downscale and isinstance(img, np.ndarray) and self._downscale_size(img) != self._sent_size:
+            self.send_state('image')
+        if self.simplify > 0 and self.polygons is not None and self._simplify_tolerance() != self._sent_tolerance:
+            self.send_state('polygons')
+
+    def _downscale_size(self, img):
+        """ Compute the (width, height) to send an image at, based on the canvas size in the browser. """
+        height, width = img.shape[:2]
+        if self.view_width <= 0 or self.view_height <= 0:
+            return width, height
+
+        scale = min(self.view_width / width, self.view_height / height)
+        if scale >= 1:
+            return width, height
+
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def _downscale_image(self, img):
+        """ Resample an image to the canvas size in the browser. """
+        self._sent_size = self._downscale_size(img)
+        if self._sent_size == (img.shape[1], img.shape[0]):
+            return img
+
+        if self.disk_cache is not None:
+            return self.disk_cache.load_resized(img, self._sent_size, self._resize_image)
+        return self._resize_image(img, self._sent_size)
+
+    def _simplify_tolerance(self):
+        """ Compute the simplification tolerance in image pixels, based on the canvas size in the browser. """
+        img = self.image
+        if img is None or self.view_width <= 0 or self.view_height <= 0:
+            return 0
+
+        height, width = img.shape[:2]
+        scale = min(self.view_width / width, self.view_height / height)
+        if not self.enlarge:
+            scale = min(scale, 1)
+
+        # Rounding to a power of 2 allows to reuse simplified polygons when the canvas size changes a bit
+        return float(2 ** np.floor(np.log2(self.simplify / scale)))
+
+    def _simplify_coords(self, coords, offsets):
+        """ Simplify packed polygon coordinates for the current display scale, caching the results. """
+        self._sent_tolerance = tolerance = self._simplify_tolerance()
+        if tolerance <= 0 or len(coords) == 0:
+            return coords, offsets
+
+        key = (hashlib.blake2b(coords).digest() + hashlib.blake2b(offsets).digest(), tolerance)
+        if key in self._simplify_cache:
+            self._simplify_cache.move_to_end(key)
+            return self._simplify_cache[key]
+
+        simplified = simplify_coords(coords, offsets, tolerance)
+        self._simplify_cache[key] = simplified
+        if len(self._simplify_cache) > 16:
+            self._simplify_cache.popitem(last=False)
+
+        return simplified
+
+    @staticmethod
+    def _resize_image(img, size):
+        return np.asarray(Image.fromarray(img).resize(size, Image.BILINEAR, reducing_gap=2.0))
+
+    def _encode_image(self, img):
+        """ Encode an image with the selected encoding. """
+        img = Image.fromarray(img)
+        if self.encoding == 'jpeg' and img.mode == 'RGBA':
+            img = img.convert('RGB')
+        elif self.encoding == 'webp' and img.mode == 'L':
+            img = img.convert('RGB')
+
+        data = BytesIO()
+        img.save(data, format=self.encoding, quality=self.quality)
+        return data.getbuffer()
+
     @traitlets.validate('polygons')
     def validate_polygons(self, proposal):
         """
         Validate correct polygon data
 
         Valid data types:
-            - list of dictionaries with keys: coords, color<optional>, alpha<optional>, size<optional>
+            - list of dictionaries with keys: coords, alt_coords<optional>, color<optional>, alpha<optional>, size<optional>, label<optional>
             - None (clears)
 
+        Note:
+            The `alt_coords` are an alternative representation of the polygon (eg. segmentation instead of bounding box),
+            which gets drawn instead of the `coords` when the `alt_coords` attribute of the canvas is True.
+            As both representations are sent to the browser, switching between them does not require sending new data.
+
         Warning:
             The individual data values are not validated, as that would slow down everything!
             It is up to the user to ensure that the values have the following types:
-                - coords: 2D numpy array with X,Y coordinates
+                - coords: 2D numpy array (or nested list) with X,Y coordinates
+                - alt_coords: 2D numpy array (or nested list) with X,Y coordinates
                 - color: RGB string
                 - alpha: 2 character HEX string (00-FF)
                 - size: Integer
         """
         poly = proposal['value']
+        self.visible = None
         self.hovered = None
         self.clicked = None
         if poly is None:
@@ -155,12 +420,38 @@ class ImageCanvas(ipywidgets.DOMWidget):
 
         if isinstance(poly, list):
             for p in poly:
-                if ('coords' not in p) or (not isinstance(p['coords'], list)):
+                if ('coords' not in p) or (not isinstance(p['coords'], (np.ndarray, list))):
                     raise ValueError('polygon coords attribute not a np.ndarray or missing')
             return poly
         else:
             raise TypeError(f'Polygons should be a list<dict> [{type(poly)}]')
 
+    @traitlets.validate('visible')
+    def validate_visible(self, proposal):
+        """
+        Validate the visibility mask of the polygons. |br|
+        Changing this mask only filters the polygons that were already sent, which is a lot faster than sending new polygons.
+
+        Valid data types:
+            - 1D boolean array with the same length as the polygons
+            - None (shows all polygons)
+        """
+        visible = proposal['value']
+        if visible is None:
+            return visible
+
+        visible = visible.astype(bool, copy=False)
+        if visible.ndim != 1:
+            raise ValueError(f'Visibility mask should be one dimensional [{visible.shape}]')
+        if self.polygons is not None and len(visible) != len(self.polygons):
+            raise ValueError(f'Visibility mask should have the same length as the polygons [{len(visible)} != {len(self.polygons)}]')
+
+        if self.hovered is not None and self.hovered < len(visible) and not visible[self.hovered]:
+            self.hovered = None
+        if self.clicked is not None and self.clicked < len(visible) and not visible[self.clicked]:
+            self.clicked = None
+        return visible
+
     @traitlets.validate('color')
     def _validate_color(self, proposal):
         """ Validate correct color type
@@ -1,7 +1,8 @@
 from pathlib import Path
 import numpy as np
-from PIL import Image
 from ._viewer import Viewer
+from ._image_canvas import EncodedImage
+from .._util import read_image
 
 __all__ = ['ImageViewer']
 
@@ -11,10 +12,12 @@ class ImageViewer(Viewer):
     This widget is a basic image browser.
 
     Args:
-        images (list-like):
-            This list-like (iterable with len) should contain your images (See Note below)
+        images (list-like, str or pathlib.Path):
+            This list-like (iterable with len) should contain your images or be the path to a `.npy` stack of images (See Note below)
         lambda_image (function, optional):
             This function gets the value from the `images` and should return a numpy array that is readable by the ImageCanvas; Default **See Note**
+        passthrough (bool, optional):
+            Send image files that browsers can decode (JPEG, PNG, WebP, ...) as is, without decoding them in Python; Default **False**
         **kwargs (dict):
             Extra keyword arguments that can be passed to :class:`~ibb.widgets.Viewer`
 
@@ -22,10 +25,19 @@ class ImageViewer(Viewer):
         The default `lambda_image` function can work with 2 types of data:
 
         - String/Path: If the images contain strings/Path-objects, it will consider them as paths to images and try to read them.
+          `.npy` files are memory-mapped instead of read in memory.
         - Other: If it is anything else it will pass the data to the `ImageCanvas` as follows: **np.asaray(<DATA>)**
+
+    Note:
+        If `images` is the path to a `.npy` file, it gets memory-mapped and each item along the first dimension is considered as an image.
+        This means an (N, H, W[, C]) stack of images can be viewed without reading it entirely in memory.
     """
-    def __init__(self, images, get_image_fn=None, **kwargs):
+    def __init__(self, images, get_image_fn=None, passthrough=False, **kwargs):
+        if isinstance(images, (str, Path)):
+            images = read_image(images)
+
         self.images = images
+        self.passthrough = passthrough
 
         if get_image_fn is not None:
             self.get_img = get_image_fn
@@ -37,10 +49,20 @@ class ImageViewer(Viewer):
 
     def get_img(self, img):
         if isinstance(img, (str, Path)):
-            return np.asarray(Image.open(img))
+            if self.passthrough:
+                encoded = EncodedImage.from_file(img)
+                if encoded is not None:
+                    return encoded
+            return self.read_image(img)
         else:
             return np.asarray(img)
 
+    def image_key(self, index):
+        return index
+
+    def load_image(self, key):
+        return self.get_img(self.images[key])
+
     def on_index(self, change):
         """ """
         img = self.images[change['new']]
@@ -50,4 +72,4 @@ class ImageViewer(Viewer):
         else:
             self.header[0].value = ''
 
-        self.main[0].image = self.get_img(img)
+        self.main[0].image = self.get_image(change['new'])
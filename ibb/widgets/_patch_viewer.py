@@ -1,14 +1,16 @@
 from math import ceil
 from pathlib import Path
 import numpy as np
-from PIL import Image
+import ipywidgets
 from ._brambox_viewer import BramboxViewer
 from ._patch_controls import PatchControls
+from .._region import RegionReader, ImagePyramid, open_region
+from .._util import get_geometry_lib, read_image
 
 try:
-    from pygeos import box as pygeos_box
+    from shapely.geometry import box as shapely_box
 except ImportError:
-    pygeos_box = None
+    shapely_box = None
 
 __all__ = ['PatchViewer']
 
@@ -20,7 +22,7 @@ class PatchViewer(BramboxViewer):
     It's arguments work a lot like brambox's `brambox.util.BoxDrawer` class.
 
     Args:
-        images (callable or dict-like object):
+        images (callable, dict-like object, numpy.ndarray, str or pathlib.Path):
             A way to get the image or path to the image from the image labels in the dataframe
         boxes (pandas.DataFrame):
             Bounding boxes to draw
@@ -36,8 +38,8 @@ class PatchViewer(BramboxViewer):
             Thickness of the border of the bounding boxes; Default **3**
         alpha (pandas.Series):
             Alpha fill value of the bounding boxes; Default **00**
-        pad (int, float or tuple of 2 int/float):
-            Padding to add around the width and height (see Note); Default **10**
+        pyramid (bool, str or pathlib.Path, kw-only):
+            Build an :class:`~ibb.ImagePyramid` of each image, which gets stored in this directory if it is a path (see Note); Default **False**
         **kwargs (dict):
             Extra keyword arguments that will be passed to :class:`~ibb.widgets.Viewer`
 
@@ -48,6 +50,19 @@ class PatchViewer(BramboxViewer):
         Otherwise the image or path is retrieved as:
         >>> image = images[image_label]
 
+        Finally, `images` can also be an (N, H, W[, C]) numpy array or the path to a `.npy` file containing such an array,
+        in which case the images are retrieved with the index of their label in the image categories of the dataframe.
+
+    Note:
+        Images are only read one patch at a time with :func:`~ibb.open_region`,
+        so that huge uncompressed images, `.npy` files and tiled TIFF files do not need to be loaded entirely in memory. |br|
+        You can also return your own :class:`~ibb.RegionReader` as image, to read patches from other formats.
+
+    Note:
+        When using a `pyramid`, patches are read from the coarsest level that still matches the resolution of the canvas in the browser,
+        and the tiles that are read are cached so that overlapping or revisited patches do not need to be read again. |br|
+        It also adds an overview button, which shows the entire image with the current patch highlighted.
+
     Note:
         The overlap property can be one of 3 possible types:
         - *int*         : A fixed pixel overlap is added to each side.
@@ -59,17 +74,28 @@ class PatchViewer(BramboxViewer):
         They can also be a single value, which will then be used for each bounding box. |br|
         Basically, as long as you can assign the value as a new column to the dataframe, it will work.
     """
-    def __init__(self, images, boxes, patch, overlap=None, label=True, color=None, size=3, alpha=0, **kwargs):
+    def __init__(self, images, boxes, patch, overlap=None, label=True, color=None, size=3, alpha=0, *, pyramid=False, **kwargs):
         self.patch = (patch, patch) if isinstance(patch, int) else tuple(patch[:2])
-        self.cache = {'label': None, 'img': None}
+        self.patch_grids = {}
+        self.pyramid = pyramid
+        self.overview = False
+        self.offset = [0, 0]
+        self.scale = 1
+        self._prepared = None
+
+        if isinstance(images, (str, Path)):
+            images = read_image(images)
 
         # Get image data
         self.img_data = []
         patch_w, patch_h = self.patch
-        for label in boxes.image.cat.categories:
-            img = images(label) if callable(images) else images[label]
-            if isinstance(img, (str, Path)):
-                img_w, img_h = Image.open(img).size
+        for image_index, label in enumerate(boxes.image.cat.categories):
+            if isinstance(images, np.ndarray):
+                img = images[image_index]
+            else:
+                img = images(label) if callable(images) else images[label]
+            if isinstance(img, (str, Path, RegionReader)):
+                img_h, img_w = open_region(img).shape[:2]
             else:
                 img_h, img_w = np.asarray(img).shape[:2]
 
@@ -103,6 +129,19 @@ class PatchViewer(BramboxViewer):
 
         self.add_class('patch-viewer')
 
+    def __init_header__(self, kwargs):
+        header = super().__init_header__(kwargs)
+        if self.pyramid is not False:
+            w_btn_overview = ipywidgets.Button(
+                icon='map-o',
+                tooltip='toggle overview',
+            )
+            w_btn_overview.add_class('ibb-square-button')
+            w_btn_overview.on_click(self.on_overview)
+            header[-1].children = (*header[-1].children, w_btn_overview)
+
+        return header
+
     def __init_footer__(self, kwargs):
         w_img_ctrl, w_index_ctrl = super().__init_footer__(kwargs)
         w_patch_ctrl = PatchControls(total_width=self.img_data[0][1], total_height=self.img_data[0][2])
@@ -151,11 +190,40 @@ class PatchViewer(BramboxViewer):
                 break
         return _image_index
 
+    def image_key(self, index):
+        # Readers are cached instead of decoded images, so they should not be mixed with the images of other viewers that share the cache
+        return ('region', self.boxes.image.cat.categories[self.index_to_control(index)])
+
+    def load_image(self, key):
+        _, label = key
+        reader = open_region(self.image_source(label))
+        if self.pyramid is False:
+            return reader
+
+        cache_dir = None if self.pyramid is True else self.pyramid
+        return ImagePyramid(reader, cache_dir=cache_dir, name=label)
+
+    def prepare_index(self, index):
+        # Read the patch in the background, so that on_index only needs to send it
+        self._prepared = ((index, self.overview), self.read_patch(index))
+
     def get_data(self, patch_index):
         # Reset image (clears screen before loading new image, so it does not look like the process is stuck)
         # This causes a slight flicker, but as this class is usually used with huge images that take a while to load, I prefer this behaviour
         self.main[0].image = None
 
+        prepared, self._prepared = self._prepared, None
+        if prepared is None or prepared[0] != (patch_index, self.overview):
+            prepared = (None, self.read_patch(patch_index))
+
+        header, patch, boxes, self.offset, self.scale = prepared[1]
+        return header, patch, boxes
+
+    def read_patch(self, patch_index):
+        """
+        Read the header, image and boxes of a patch, together with the offset and scale of the image w.r.t. the full resolution. |br|
+        This method does not modify the viewer, so that it can run in a background thread.
+        """
         # Get current image and patch index
         for _image_index, imgdata in enumerate(self.img_data):
             if patch_index >= imgdata[0]:
@@ -172,41 +240,150 @@ class PatchViewer(BramboxViewer):
         y1 = y0 + self.patch[1]
 
         # Get data
-        label = str(self.boxes.image.cat.categories[_image_index])
+        label = self.boxes.image.cat.categories[_image_index]
 
         # Get Image
-        if self.cache['label'] == label:
-            img = self.cache['img']
+        key = ('region', label)
+        img = self.get_image(key)
+        if self.overview:
+            patch, offset, scale = self.get_overview(img, x0, y0, x1, y1)
+        elif isinstance(img, ImagePyramid):
+            patch, offset, scale = self.get_pyramid_patch(img, x0, y0, x1, y1)
         else:
-            img = self.images(label) if callable(self.images) else self.images[label]
-            if isinstance(img, (str, Path)):
-                img = np.asarray(Image.open(img))
-            else:
-                img = np.asarray(img)
+            patch, offset, scale = img[y0:y1, x0:x1], [x0, y0], 1
 
-            self.cache = {
-                'label': label,
-                'img': img,
-            }
-        self.cache['pad'] = [x0, y0]
+        # Readers decode their image and pyramids compute levels and tiles lazily, so their memory usage changes after reading
+        self.cache.update(key)
 
         # Get boxes
-        boxes = self.boxes[self.boxes.image == label].copy()
+        boxes = self.get_boxes(_image_index)
+        grid = self.get_grid(_image_index, boxes)
+        candidates = grid.query(idx_w, idx_h)
 
-        if self.draw_box_max == 3:
-            boundary = pygeos_box(x0, y0, x1, y1)
-            boxes = boxes[boxes.segmentation.apply(lambda s: s.intersects(boundary))]
+        if grid.lib is not None:
+            geometries = boxes.segmentation.values[candidates]
+            candidates = candidates[grid.lib.intersects(geometries, grid.lib.box(x0, y0, x1, y1))]
         else:
-            boxes = boxes[
-                ((boxes.x_top_left <= x1) & ((boxes.x_top_left + boxes.width) >= x0)) &
-                ((boxes.y_top_left <= y1) & ((boxes.y_top_left + boxes.height) >= y0))
-            ]
-
-        return f'{label} (x={idx_w}, y={idx_h})', img[y0:y1, x0:x1], boxes
+            bounds = grid.bounds[candidates]
+            candidates = candidates[(bounds[:, 0] <= x1) & (bounds[:, 2] >= x0) & (bounds[:, 1] <= y1) & (bounds[:, 3] >= y0)]
+            if self.draw_box_max == 3 and shapely_box is not None:
+                # Geometries without vectorized library support (eg. shapely<2.0)
+                boundary = shapely_box(x0, y0, x1, y1)
+                candidates = candidates[[boxes.segmentation.iat[i].intersects(boundary) for i in candidates]]
+
+        boxes = boxes.iloc[candidates]
+
+        header = f'{label} (x={idx_w}, y={idx_h})'
+        if self.overview:
+            header += ' [overview]'
+
+        return header, patch, boxes, offset, scale
+
+    def get_pyramid_patch(self, pyramid, x0, y0, x1, y1):
+        """ Read a patch from the coarsest level of the pyramid that still matches the resolution of the canvas and return it with its offset and scale. """
+        level = pyramid.select_level(x1 - x0, y1 - y0, self.main[0].view_width, self.main[0].view_height)
+        scale = 2 ** level
+        lx0, ly0 = x0 // scale, y0 // scale
+
+        return pyramid.read(lx0, ly0, ceil(x1 / scale), ceil(y1 / scale), level), [lx0 * scale, ly0 * scale], scale
+
+    def get_overview(self, pyramid, x0, y0, x1, y1):
+        """ Get the entire image from the pyramid, with the outline of the current patch highlighted, and return it with its offset and scale. """
+        height, width = pyramid.shape[:2]
+        view_width = self.main[0].view_width or 1024
+        view_height = self.main[0].view_height or 1024
+        level = pyramid.select_level(width, height, view_width, view_height)
+        scale = 2 ** level
+
+        img = pyramid.read(0, 0, width, height, level).copy()
+        height, width = img.shape[:2]
+        x0, y0 = min(x0 // scale, width - 1), min(y0 // scale, height - 1)
+        x1, y1 = min(ceil(x1 / scale), width), min(ceil(y1 / scale), height)
+        maximum = 255 if img.dtype == np.uint8 else 1
+
+        # Invert the pixels of the outline, so it is visible on any background
+        for region in (
+            img[y0:y0 + 2, x0:x1],
+            img[max(y1 - 2, y0):y1, x0:x1],
+            img[y0 + 2:max(y1 - 2, y0), x0:x0 + 2],
+            img[y0 + 2:max(y1 - 2, y0), max(x1 - 2, x0):x1],
+        ):
+            region[...] = maximum - region
+
+        return img, [0, 0], scale
+
+    def get_grid(self, index, boxes):
+        """ Get the spatial index of the image with the given category index, which is built the first time the image is visited. """
+        if index not in self.patch_grids:
+            num_w, num_h, ov_w, ov_h = self.img_data[index][1:]
+            self.patch_grids[index] = _PatchGrid(boxes, self.draw_box_max == 3, self.patch, (num_w, num_h), (ov_w, ov_h))
+        return self.patch_grids[index]
+
+    def on_overview(self, btn):
+        self.overview = not self.overview
+        self.redraw()
 
     def draw_boxes(self, boxes):
-        boxes['boxcoords'] = boxes['boxcoords'].apply(lambda c: c - self.cache['pad'])
+        boxes['boxcoords'] = boxes['boxcoords'].apply(lambda c: (c - self.offset) / self.scale)
         if 'maskcoords' in boxes:
-            boxes['maskcoords'] = boxes['maskcoords'].apply(lambda c: c - self.cache['pad'])
+            boxes['maskcoords'] = boxes['maskcoords'].apply(lambda c: (c - self.offset) / self.scale)
 
         super().draw_boxes(boxes)
+
+
+class _PatchGrid:
+    """
+    Grid bucket spatial index, where each bucket corresponds to the non-overlapping part of a patch. |br|
+    Each object is stored in every bucket its bounds overlap with, so querying a patch only needs to look at the few buckets it covers.
+
+    Args:
+        boxes (pandas.DataFrame): Boxes of a single image
+        masks (bool): Whether to index the segmentation geometries instead of the bounding boxes
+        patch (tuple of 2 int): Width and height of a patch
+        num (tuple of 2 int): Number of patches in the width and height
+        overlap (tuple of 2 int): Overlap between patches in the width and height
+    """
+    def __init__(self, boxes, masks, patch, num, overlap):
+        self.lib = get_geometry_lib(boxes.segmentation.values) if masks else None
+        if self.lib is not None:
+            self.bounds = self.lib.bounds(boxes.segmentation.values)
+        elif masks:
+            self.bounds = np.array([s.bounds for s in boxes.segmentation], dtype=np.float64).reshape(-1, 4)
+        else:
+            x0 = boxes.x_top_left.values
+            y0 = boxes.y_top_left.values
+            self.bounds = np.stack([x0, y0, x0 + boxes.width.values, y0 + boxes.height.values], axis=1).reshape(-1, 4)
+
+        # Buckets have the size of the patch step, so a patch covers its own bucket and a few more because of the overlap
+        self.step = (max(patch[0] - overlap[0], 1), max(patch[1] - overlap[1], 1))
+        self.span = (patch[0] // self.step[0], patch[1] // self.step[1])
+        self.cols = num[0] + self.span[0]
+        self.rows = num[1] + self.span[1]
+
+        # Compute bucket ranges of each object (objects outside of the grid are clipped to the border buckets)
+        bx0 = np.clip(np.floor(self.bounds[:, 0] / self.step[0]), 0, self.cols - 1).astype(np.int64)
+        bx1 = np.clip(np.floor(self.bounds[:, 2] / self.step[0]), 0, self.cols - 1).astype(np.int64)
+        by0 = np.clip(np.floor(self.bounds[:, 1] / self.step[1]), 0, self.rows - 1).astype(np.int64)
+        by1 = np.clip(np.floor(self.bounds[:, 3] / self.step[1]), 0, self.rows - 1).astype(np.int64)
+        width = bx1 - bx0 + 1
+        count = width * (by1 - by0 + 1)
+
+        # Expand each object to all of its buckets and group the objects per bucket
+        objects = np.repeat(np.arange(len(count)), count)
+        local = np.arange(objects.shape[0]) - np.repeat(np.cumsum(count) - count, count)
+        buckets = (by0[objects] + local // width[objects]) * self.cols + (bx0[objects] + local % width[objects])
+
+        order = np.argsort(buckets, kind='stable')
+        self.objects = objects[order]
+        self.offsets = np.searchsorted(buckets[order], np.arange(self.cols * self.rows + 1))
+
+    def query(self, idx_w, idx_h):
+        """ Return the sorted positional indices of the objects whose bounds might overlap with a certain patch. """
+        x0, x1 = idx_w, min(idx_w + self.span[0], self.cols - 1)
+        y0, y1 = idx_h, min(idx_h + self.span[1], self.rows - 1)
+
+        candidates = [
+            self.objects[self.offsets[row * self.cols + x0]:self.offsets[row * self.cols + x1 + 1]]
+            for row in range(y0, y1 + 1)
+        ]
+        return np.unique(np.concatenate(candidates))
@@ -1,11 +1,12 @@
+import threading
+from collections import OrderedDict, deque
 from collections.abc import Mapping, Sequence
 import numpy as np
 import ipywidgets
 import brambox as bb
 import pandas as pd
-from brambox.util._visual import setup_boxes
 from ._viewer import Viewer
-from .._util import cast_alpha, box_to_coords, mask_to_coords
+from .._util import cast_alpha, boxes_to_coords, masks_to_coords
 
 try:
     import torch
@@ -33,6 +34,12 @@ class TorchViewer(Viewer):
             Thickness of the border of the bounding boxes; Default **3**
         alpha (pandas.Series or callable):
             Alpha fill value of the bounding boxes; Default **00**
+        num_workers (int, kw-only):
+            Number of worker processes of a :class:`torch.utils.data.DataLoader` that loads the samples in the navigation direction in advance (see Note); Default **0**
+        prefetch_factor (int, kw-only):
+            Number of samples loaded in advance by each worker; Default **2**
+        loader_kwargs (dict, kw-only):
+            Extra keyword arguments for the :class:`torch.utils.data.DataLoader` (eg. `multiprocessing_context`); Default **None**
         **kwargs (dict):
             Extra keyword arguments that will be passed to :class:`~ibb.widgets.Viewer`
 
@@ -43,13 +50,21 @@ class TorchViewer(Viewer):
         Basically, as long as you can assign the value as a new column to the dataframe, it will work.
 
         Finally, if these values are callable, they get called with the boxes dataframe and should return a valid pandas series.
+
+    Note:
+        When `num_workers` is bigger than zero, samples are loaded by a :class:`torch.utils.data.DataLoader`,
+        whose sampler follows the navigation of the viewer and yields the next indices in the current direction (and step size). |br|
+        Samples that are ready when you navigate to them are used immediately, other samples are loaded synchronously like before.
+        As the samples are loaded in other processes, your dataset needs to be picklable.
     """
-    def __init__(self, data, extract_data=None, label=True, color=None, size=3, alpha=0, **kwargs):
+    def __init__(self, data, extract_data=None, label=True, color=None, size=3, alpha=0, *, num_workers=0, prefetch_factor=2, loader_kwargs=None, **kwargs):
         assert torch is not None, 'PyTorch is required for this widget'
 
         self.data = data
+        self.fetcher = None
         self.extract_data = extract_data if callable(extract_data) else default_extract_data
-        self.columns = (label, color, size, alpha)
+        self.style = _BoxStyle(label, color, size, alpha)
+        self._example = None
 
         # Metadata
         self.info = False
@@ -58,10 +73,17 @@ class TorchViewer(Viewer):
         self.draw_box_text = ['none', 'box', 'mask']
         self.draw_box = self.draw_box_max - 1
 
-        # Example dataframe for setup
-        _, _, boxes = self.get_data(0)
+        # Example dataframe for setup (kept to draw the first image without loading it again)
+        lbl, img, boxes = self.get_data(0)
         kwargs['_example_boxes'] = boxes
         self.draw_box_max = 3 if 'segmentation' in boxes.columns else 2
+        if self.draw_box_max == 3:
+            boxes['maskcoords'] = masks_to_coords(boxes)
+        self._example = (0, (lbl, img, boxes))
+
+        # Background loading
+        if num_workers > 0:
+            self.fetcher = _DataLoaderFetcher(self.data, num_workers, prefetch_factor, loader_kwargs or {})
 
         # ImageCanvas arguments
         if 'hover_style' not in kwargs:
@@ -129,8 +151,19 @@ class TorchViewer(Viewer):
 
         return [w_conf_slider]
 
+    def get_sample(self, index):
+        """ Get a sample from the dataset, which is served by the DataLoader workers if possible. """
+        if self.fetcher is None:
+            return self.data[index]
+        return self.fetcher.get(index)
+
     def get_data(self, index):
-        img, boxes = self.extract_data(self.data[index])
+        if self._example is not None:
+            example_index, example, self._example = *self._example, None
+            if example_index == index:
+                return example
+
+        img, boxes = self.extract_data(self.get_sample(index))
 
         # Image setup
         if isinstance(img, torch.Tensor):
@@ -138,22 +171,10 @@ class TorchViewer(Viewer):
         img = np.asarray(img)
 
         # Dataframe setup
-        label, color, size, alpha = self.columns
-        if callable(label):
-            label = label(boxes)
-        if callable(color):
-            color = color(boxes)
-        if callable(size):
-            size = size(boxes)
-        if callable(alpha):
-            alpha = alpha(boxes)
-
-        boxes = setup_boxes(boxes, label=label, color=color, size=size, alpha=alpha)
-        boxes.color = 'rgb' + boxes.color.astype(str)
-        boxes['alpha'] = boxes['alpha'].apply(cast_alpha)
-        boxes['boxcoords'] = boxes.apply(box_to_coords, axis=1)
+        boxes = self.style(boxes)
+        boxes['boxcoords'] = boxes_to_coords(boxes)
         if self.draw_box_max == 3:
-            boxes['maskcoords'] = boxes.apply(mask_to_coords, axis=1)
+            boxes['maskcoords'] = masks_to_coords(boxes)
 
         # Label
         try:
@@ -165,11 +186,15 @@ class TorchViewer(Viewer):
 
         return lbl, img, boxes
 
+    def prepare_index(self, index):
+        # Load and set up the sample in the background, so that on_index can draw it without calling the dataset
+        self._example = (index, self.get_data(index))
+
     def draw_boxes(self, boxes):
         if self.draw_box:
             bboxes = boxes[['color', 'size', 'alpha']].copy()
             coord_col = 'maskcoords' if self.draw_box == 2 else 'boxcoords'
-            bboxes['coords'] = boxes[coord_col].apply(lambda c: c.tolist())
+            bboxes['coords'] = boxes[coord_col]
             bboxes['label'] = boxes['class_label']
             if 'confidence' in boxes:
                 bboxes['label'] += boxes['confidence'].apply(lambda num: f' ({num:.2%})')
@@ -177,16 +202,27 @@ class TorchViewer(Viewer):
         else:
             self.main[0].polygons = None
 
-    def on_index(self, change):
-        """ """
-        self.header[0].value, self.main[0].image, self.current_all_boxes = self.get_data(change['new'])
-
+    def filter_boxes(self):
+        """ Compute which of the boxes of the current image pass the confidence threshold. """
         if self.conf_enabled:
-            self.current_boxes = self.current_all_boxes[self.current_all_boxes['confidence'] >= self.side[0].value]
+            self.current_visible = (self.current_all_boxes['confidence'] >= self.side[0].value).to_numpy()
+            self.current_boxes = self.current_all_boxes[self.current_visible]
         else:
+            self.current_visible = None
             self.current_boxes = self.current_all_boxes
 
-        self.draw_boxes(self.current_boxes.copy())
+    def on_index(self, change):
+        """ """
+        self.header[0].value, self.main[0].image, self.current_all_boxes = self.get_data(change['new'])
+        self.on_overlay()
+
+    def on_overlay(self):
+        """ """
+        # All boxes are sent, so that the threshold can be changed by only sending a new visibility mask
+        with self.main[0].hold_sync():
+            self.filter_boxes()
+            self.draw_boxes(self.current_all_boxes.copy())
+            self.main[0].visible = self.current_visible
 
     def on_save(self, btn):
         self.main[0].save = True
@@ -194,7 +230,7 @@ class TorchViewer(Viewer):
     def on_box(self, btn):
         self.draw_box = (self.draw_box + 1) % self.draw_box_max
         btn.tooltip = f'toggle none/box/mask [{self.draw_box_text[self.draw_box]}]'
-        self.redraw()
+        self.redraw(image=False)
 
     def on_info(self, btn):
         self.info = not self.info
@@ -210,7 +246,7 @@ class TorchViewer(Viewer):
             self.main[-1].value = ''
             return
 
-        self.clicked = self.current_boxes.iloc[clicked]
+        self.clicked = self.current_all_boxes.iloc[clicked]
         columns = (
             sorted(self.clicked.index.difference([
                 'image',
@@ -244,26 +280,156 @@ class TorchViewer(Viewer):
         # Option 1 : Same object (keep clicked when toggling box/mask)
         index = self.clicked.name
         if index in self.current_boxes.index:
-            self.main[0].clicked = self.current_boxes.index.get_loc(index)
-            self.clicked = self.current_boxes.loc[index]
+            self.main[0].clicked = self.current_all_boxes.index.get_loc(index)
+            self.clicked = self.current_all_boxes.loc[index]
             return
 
         # Option 2 : Object with same class and id (useful in tracking context)
         label = self.clicked['class_label']
         id = self.clicked['id']
-        new_clicked = (self.current_boxes['class_label'] == label) & (self.current_boxes['id'] == id)
+        new_clicked = (self.current_all_boxes['class_label'] == label) & (self.current_all_boxes['id'] == id)
+        if self.current_visible is not None:
+            new_clicked &= self.current_visible
 
         if new_clicked.any():
             index = int(new_clicked.values.argmax())
             self.main[0].clicked = index
-            self.clicked = self.current_boxes.iloc[index]
+            self.clicked = self.current_all_boxes.iloc[index]
             return
 
         # Default: Reset clicked
         self.clicked = None
 
     def on_threshold(self, change):
-        self.redraw()
+        # Fast path: only send a new visibility mask for the polygons that were already sent
+        self.filter_boxes()
+        with self.main[0].hold_sync():
+            self.main[0].visible = self.current_visible
+
+            # Reset clicked if it got hidden by the threshold
+            if self.clicked is not None and self.clicked.name not in self.current_boxes.index:
+                self.clicked = None
+                self.main[0].clicked = None
+
+
+class _BoxStyle:
+    """
+    Styling plan that adds the color, size, label and alpha columns to the boxes of a sample. |br|
+    Constant values are resolved once and the default colors are stored in a class_label to color map,
+    so that only callables need to be evaluated for each sample and every class keeps its color across samples.
+    """
+    default_colors = [
+        (31, 119, 180),
+        (255, 127, 14),
+        (44, 160, 44),
+        (214, 39, 40),
+        (148, 103, 189),
+        (140, 86, 75),
+        (227, 119, 194),
+        (127, 127, 127),
+        (188, 189, 34),
+        (23, 190, 207),
+    ]
+    coords = ['x_top_left', 'y_top_left', 'width', 'height']
+
+    def __init__(self, label=True, color=None, size=3, alpha=0):
+        self.label = label
+        self.color = color
+        self.size = size
+        self.alpha = alpha
+        self.palette = {i: self.cast_color(c) for i, c in enumerate(self.default_colors)}
+        self.class_colors = {}
+        self.alpha_cache = {}
+
+        # Resolve constant values once
+        if self.is_constant(color):
+            self.color = self.cast_color(color)
+        if self.is_constant(size):
+            self.size = int(size)
+        if self.is_constant(alpha):
+            self.alpha = self.cast_alpha(float(alpha))
+
+    def __call__(self, boxes):
+        boxes = boxes.copy()
+
+        # Filter NaN and Inf coordinates
+        valid = np.isfinite(boxes[self.coords].to_numpy(dtype=float)).all(axis=1)
+        if not valid.all():
+            boxes = boxes[valid]
+
+        if 'color' in boxes.columns:
+            boxes['color'] = self.map_color(boxes['color'])
+        elif self.color is None:
+            boxes['color'] = self.get_class_colors(boxes['class_label'])
+        elif self.is_constant(self.color):
+            boxes['color'] = self.color
+        else:
+            boxes['color'] = self.color(boxes) if callable(self.color) else self.color
+            boxes['color'] = self.map_color(boxes['color'])
+
+        if 'size' not in boxes.columns:
+            if self.is_constant(self.size):
+                boxes['size'] = self.size
+            else:
+                boxes['size'] = self.size(boxes) if callable(self.size) else self.size
+                boxes['size'] = boxes['size'].astype(int)
+
+        if 'label' not in boxes.columns:
+            boxes['label'] = self.get_label(boxes)
+
+        if 'alpha' in boxes.columns:
+            boxes['alpha'] = boxes['alpha'].map(self.cast_alpha)
+        elif self.is_constant(self.alpha):
+            boxes['alpha'] = self.alpha
+        else:
+            boxes['alpha'] = self.alpha(boxes) if callable(self.alpha) else self.alpha
+            boxes['alpha'] = boxes['alpha'].astype(float).map(self.cast_alpha)
+
+        return boxes
+
+    def get_class_colors(self, labels):
+        """ Map class labels to colors, assigning the next default color to labels that were not seen before. """
+        for label in sorted(set(labels.unique()).difference(self.class_colors)):
+            self.class_colors[label] = self.palette[len(self.class_colors) % len(self.palette)]
+        return labels.map(self.class_colors)
+
+    def get_label(self, boxes):
+        label = self.label(boxes) if callable(self.label) else self.label
+        if label is not True:
+            return label
+
+        label = boxes['class_label'].astype(str)
+        if 'id' in boxes.columns:
+            label += (' ' + boxes['id'].astype(str)).where(boxes['id'].notna(), '')
+        if 'confidence' in boxes.columns:
+            label += ' [' + (boxes['confidence'] * 100).round(2).astype(str) + '%]'
+        return label
+
+    def map_color(self, color):
+        if pd.api.types.is_integer_dtype(color):
+            return (color % len(self.palette)).map(self.palette)
+        return color.map(self.cast_color)
+
+    def cast_alpha(self, alpha):
+        if alpha not in self.alpha_cache:
+            self.alpha_cache[alpha] = cast_alpha(alpha)
+        return self.alpha_cache[alpha]
+
+    @staticmethod
+    def is_constant(value):
+        if isinstance(value, str):
+            return True
+        if isinstance(value, Sequence):
+            return len(value) == 3 and isinstance(value[0], (int, np.integer))
+        return value is not None and not callable(value) and np.isscalar(value)
+
+    @staticmethod
+    def cast_color(color):
+        if isinstance(color, str) and color.startswith('rgb'):
+            return color
+        if isinstance(color, Sequence) and not isinstance(color, str):
+            return 'rgb(' + ', '.join(str(int(c)) for c in color) + ')'
+        return 'rgb' + str(color)
 
 
 def default_extract_data(output):
@@ -293,3 +459,142 @@ def default_extract_data(output):
         anno = bb.util.new('anno')
 
     return img, anno
+
+
+class _IndexedDataset:
+    """ Dataset wrapper that returns the index together with the sample, so that we know which sample the DataLoader returns. """
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        # Padding indices of the sampler are not loaded
+        if index is None:
+            return None, None
+        return index, self.data[index]
+
+
+def _identity(sample):
+    return sample
+
+
+class _NavigationSampler:
+    """
+    Infinite sampler that yields the indices that follow the current navigation position and step. |br|
+    Every index is only dispatched once while it is buffered or being loaded.
+    When all of them are, the sampler yields None as padding, which the workers return without loading anything.
+    """
+    def __init__(self, lock):
+        self.lock = lock
+        self.order = []
+        self.dispatched = deque()
+        self.ready = set()
+
+    def __iter__(self):
+        while True:
+            # Indices are drawn from the receiving thread, while the kernel thread changes the navigation
+            with self.lock:
+                index = next((i for i in self.order if i not in self.ready and i not in self.dispatched), None)
+                self.dispatched.append(index)
+            yield index
+
+
+class _DataLoaderFetcher:
+    """
+    Serves samples from a DataLoader with worker processes, whose sampler follows the navigation. |br|
+    Samples are received in a background thread, which keeps the ones in the navigation direction and drops the stale ones as they arrive.
+    The thread only receives samples while some of the indices in the navigation direction are not buffered yet,
+    so that the workers stay idle once they are.
+    """
+    def __init__(self, data, num_workers, prefetch_factor, loader_kwargs):
+        self.data = data
+        self.total = len(data)
+        self.condition = threading.Condition()
+        self.sampler = _NavigationSampler(self.condition)
+        self.loader = torch.utils.data.DataLoader(
+            _IndexedDataset(data),
+            batch_size=None,
+            sampler=self.sampler,
+            collate_fn=_identity,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            persistent_workers=True,
+            **loader_kwargs,
+        )
+        self.iterator = None
+        self.thread = None
+        self.buffer = OrderedDict()
+        self.max_buffer = 2 * num_workers * prefetch_factor
+        self.wanted = set()
+        self.step = 1
+        self.last = None
+
+    def get(self, index):
+        with self.condition:
+            # Follow the navigation direction and step size
+            if self.last is not None and index != self.last:
+                self.step = index - self.last
+            self.last = index
+
+            # The navigation can visit less than max_buffer distinct indices (eg. small datasets or going back and forth)
+            order = (((index + self.step * i) % self.total) for i in range(1, self.max_buffer + 1))
+            self.sampler.order = list(OrderedDict.fromkeys(order))
+            self.wanted = set(self.sampler.order)
+
+            # Drop buffered samples that are no longer in the navigation direction
+            for key in [key for key in self.buffer if key not in self.wanted and key != index]:
+                del self.buffer[key]
+
+            if self.thread is None:
+                self.iterator = iter(self.loader)
+                self.thread = threading.Thread(target=self._receive, name='ibb-dataloader', daemon=True)
+                self.thread.start()
+
+            # Samples that are being loaded are waited for, stale samples that arrive in the meantime get dropped by the thread
+            if index not in self.buffer and index in self.sampler.dispatched:
+                self.wanted.add(index)
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: index in self.buffer or index not in self.sampler.dispatched or self.thread is None)
+
+            sample = self.buffer.pop(index, None)
+            self.sampler.ready = set(self.buffer)
+            self.condition.notify_all()
+
+        # Errors of the DataLoader get raised again by loading the sample synchronously
+        if sample is None:
+            sample = self.data[index]
+        return sample
+
+    def _receiving(self):
+        # A wanted sample is being loaded or a wanted index still needs to be dispatched, which happens when receiving a sample
+        dispatched = self.sampler.dispatched
+        return (
+            any(i in self.wanted for i in dispatched)
+            or any(i not in self.buffer and i not in dispatched for i in self.sampler.order)
+        )
+
+    def _receive(self):
+        """ Receive samples in the order they were dispatched, until all samples in the navigation direction are buffered. """
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(self._receiving)
+
+                # Receiving a sample makes the DataLoader dispatch the next index of the navigation
+                received, sample = next(self.iterator)
+
+                with self.condition:
+                    self.sampler.dispatched.remove(received)
+                    if received is not None and received in self.wanted:
+                        self.buffer[received] = sample
+                        self.sampler.ready = set(self.buffer)
+                    self.condition.notify_all()
+        except BaseException:
+            # Start over with a new iterator on the next call
+            with self.condition:
+                self.iterator = None
+                self.thread = None
+                self.sampler.dispatched.clear()
+                self.condition.notify_all()
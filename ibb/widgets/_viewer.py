@@ -1,4 +1,12 @@
 import ipywidgets
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import traitlets
+from .._cache import ImageCache, ImagePrefetcher, DiskCache
+from .._util import read_image
 from ._unlink_box import UnlinkBox
 from ._image_canvas import ImageCanvas
 from ._image_controls import ImageControls
@@ -15,9 +23,14 @@ class Viewer(UnlinkBox):
     Each of the different \\_\\_init_*\\_\\_ methods has different keyword arguments that are used to control the base implementations. |br|
     See their documentation for more information.
 
+    Args:
+        fps (Float): Frame rate achieved by the viewer over the last few seconds, when the viewer is throttled (read-only)
+
     Warning:
         It is important to note that you can only add widgets in the various init methods and cannot change them afterwards!
     """
+    fps = traitlets.Float(0, read_only=True)
+
     def __init__(self, **kwargs):
         # Create child widgets
         self.__header = tuple(self.__init_header__(kwargs))
@@ -60,7 +73,7 @@ class Viewer(UnlinkBox):
         Initialize widgets that are placed in the main area. |br|
         The default implementation places an :class:`~ibb.widgets.ImageCanvas`, which can be accessed through :prop:`Viewer.main`.
         """
-        canvas_names = {'enable_poly', 'auto_clear', 'enlarge', 'color', 'alpha', 'size', 'hover_style', 'click_style'}
+        canvas_names = {'enable_poly', 'auto_clear', 'enlarge', 'color', 'alpha', 'size', 'hover_style', 'click_style', 'downscale', 'encoding', 'quality', 'sync_hover', 'sync_rate', 'offscreen', 'simplify'}
         canvas_kwargs = {k: v for k, v in kwargs.items() if k in canvas_names}
         w_canvas = ImageCanvas(**canvas_kwargs)
 
@@ -81,6 +94,27 @@ class Viewer(UnlinkBox):
         Args:
             total (number, kw-only): Maximum number for the :class:`~ibb.widgets.IndexCounter`; Default **1**
             control_total (number, kw-only): Maximum number for the :class:`~ibb.widgets.ImageControls`; Default **value from total**
+            cache (ImageCache or number, kw-only): :class:`~ibb.ImageCache` to share with other viewers of the same dataset or memory budget in bytes for a new cache; Default **512MiB**
+            prefetch (number, kw-only): Number of indices to look ahead in the current navigation direction, whose images get decoded in the background; Default **0**
+            prefetch_workers (number, kw-only): Number of background threads used for prefetching; Default **2**
+            throttle (bool, kw-only): Coalesce index changes and only draw them at the rate the viewer can sustain (see Note); Default **False**
+            asynchronous (bool, kw-only): Load the data of new indices in a background thread, so that the kernel stays responsive (see Note); Default **False**
+            disk_cache (DiskCache, str or pathlib.Path, kw-only): :class:`~ibb.DiskCache` or directory for a new disk cache, which stores decoded and resized images across sessions; Default **None**
+
+        Note:
+            In throttled mode, index changes are not drawn immediately, but scheduled on the asyncio event loop.
+            The time between two draws is at least the time it takes to draw, averaged over the last few draws,
+            so that index changes which arrive in the meantime (eg. by holding down a button) get coalesced and only the latest index gets drawn.
+            In asynchronous mode, this includes the time it takes to load the index in the background. |br|
+            The achieved frame rate can be read from the `fps` attribute.
+            This requires a running asyncio event loop (eg. a Jupyter kernel), otherwise indices are drawn immediately.
+
+        Note:
+            In asynchronous mode, index changes first run :meth:`Viewer.prepare_index` in a background thread
+            and only run :meth:`Viewer.on_index` once it is done.
+            When the index changes again in the meantime, pending loads are cancelled and the results of running loads are discarded,
+            so that only the latest index gets shown. |br|
+            This requires a running asyncio event loop (eg. a Jupyter kernel), otherwise indices are loaded synchronously.
 
         Warning:
             If you override this function, you should only ever add to it and still call ``super().__init_footer__(kwargs)``, as the class would otherwise break !
@@ -102,7 +136,43 @@ class Viewer(UnlinkBox):
 
         self.__w_idx.observe(_on_index, 'index')
         w_ctrl.observe(_on_control, 'index')
-        self.__w_idx.observe(self.on_index, 'index')
+        self.__executor = None
+        self.__future = None
+        self.__generation = 0
+        if kwargs.get('asynchronous', False):
+            self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ibb-load')
+            self.__draw = self._on_index_async
+        else:
+            self.__draw = self._on_index_sync
+
+        self.__pending = None
+        self.__scheduled = None
+        self.__frame_start = None
+        self.__frame_time = 0
+        self.__next_frame = 0
+        self.__frames = deque(maxlen=64)
+        if kwargs.get('throttle', False):
+            self.__w_idx.observe(self._on_index_throttled, 'index')
+        else:
+            self.__w_idx.observe(self.__draw, 'index')
+
+        # Image cache and prefetching
+        self.__cache = kwargs.get('cache', 512 * 2**20)
+        if not isinstance(self.__cache, ImageCache):
+            self.__cache = ImageCache(self.__cache)
+        self.__pin_owner = object()
+
+        self.__disk_cache = kwargs.get('disk_cache', None)
+        if self.__disk_cache is not None and not isinstance(self.__disk_cache, DiskCache):
+            self.__disk_cache = DiskCache(self.__disk_cache)
+        if len(self.__main) and isinstance(self.__main[0], ImageCanvas):
+            self.__main[0].disk_cache = self.__disk_cache
+
+        self.__prefetch = kwargs.get('prefetch', 0)
+        self.__direction = (1, 1)
+        self.__prefetcher = None
+        if self.__prefetch > 0:
+            self.__prefetcher = ImagePrefetcher(self.load_image, self.__cache, kwargs.get('prefetch_workers', 2))
 
         return [w_ctrl, self.__w_idx]
 
@@ -119,6 +189,173 @@ class Viewer(UnlinkBox):
         """
         raise NotImplementedError('abstractmethod')
 
+    def on_overlay(self):
+        """
+        Method that redraws everything that is drawn on top of the current image, without reloading the image itself. |br|
+        Widgets can implement this method to make changes to their overlay cheaper; by default it runs :meth:`Viewer.on_index`.
+        """
+        self.redraw()
+
+    def _on_index_throttled(self, change):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.__draw(change)
+            return
+
+        # Coalesce with the pending change, which has not been drawn yet
+        if self.__pending is not None:
+            change = {**change, 'old': self.__pending['old']}
+        self.__pending = change
+
+        # A frame that is still loading in the background schedules the next one when it is done
+        if self.__scheduled is None and self.__frame_start is None:
+            delay = max(0, self.__next_frame - time.perf_counter())
+            self.__scheduled = loop.call_later(delay, self._on_frame)
+
+    def _on_frame(self):
+        change = self.__pending
+        self.__pending = None
+        self.__scheduled = None
+        if change is None:
+            return
+
+        self.__frame_start = time.perf_counter()
+        try:
+            self.__draw(change)
+        except BaseException:
+            self._end_frame()
+            raise
+
+    def _end_frame(self):
+        if self.__frame_start is None:
+            return
+
+        start = self.__frame_start
+        self.__frame_start = None
+        end = time.perf_counter()
+
+        # Wait at least as long as drawing takes, so that the kernel can process other messages in between frames
+        self.__frame_time = 0.7 * self.__frame_time + 0.3 * (end - start) if self.__frames else end - start
+        self.__next_frame = end + self.__frame_time
+
+        self.__frames.append(end)
+        while end - self.__frames[0] > 2:
+            self.__frames.popleft()
+        fps = (len(self.__frames) - 1) / (end - self.__frames[0]) if len(self.__frames) > 1 else 0
+        self.set_trait('fps', fps)
+
+        # Schedule the changes that arrived while drawing
+        if self.__pending is not None and self.__scheduled is None:
+            delay = max(0, self.__next_frame - end)
+            self.__scheduled = asyncio.get_running_loop().call_later(delay, self._on_frame)
+
+    def _on_index_sync(self, change):
+        # Frames end when the index is drawn, which happens in _on_index_done for asynchronous viewers
+        try:
+            self.on_index(change)
+        finally:
+            self._end_frame()
+
+        # Only prefetch around indices that actually get drawn, so that skipped indices do not load their neighbours
+        if self.__prefetcher is not None:
+            self._on_prefetch(change)
+
+    def prepare_index(self, index):
+        """
+        Method that loads the data of an index in a background thread when the viewer is asynchronous. |br|
+        The default implementation loads the image of the index into the :prop:`Viewer.cache`, so that :meth:`Viewer.on_index` can use it immediately.
+        """
+        key = self.image_key(index)
+        if key is not None:
+            self.get_image(key)
+
+    def _on_index_async(self, change):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._on_index_sync(change)
+            return
+
+        # Newer indices supersede older ones
+        self.__generation += 1
+        generation = self.__generation
+        if self.__future is not None:
+            self.__future.cancel()
+
+        def _done(future):
+            if not future.cancelled():
+                loop.call_soon_threadsafe(self._on_index_done, generation, change, future)
+
+        self.__future = self.__executor.submit(self.prepare_index, change['new'])
+        self.__future.add_done_callback(_done)
+
+    def _on_index_done(self, generation, change, future):
+        if generation != self.__generation:
+            return
+
+        # Errors get raised again by running on_index synchronously
+        self.__future = None
+        self._on_index_sync(change)
+
+    def image_key(self, index):
+        """
+        Return a hashable key that identifies the image shown at a certain index. |br|
+        Images are only prefetched if this method is implemented.
+        """
+        return None
+
+    def load_image(self, key):
+        """
+        Read and decode the image of a certain key (see :meth:`Viewer.image_key`). |br|
+        This method gets called from background threads when prefetching and should thus be thread-safe.
+        """
+        raise NotImplementedError('abstractmethod')
+
+    def read_image(self, path):
+        """ Read an image file, which goes through the :prop:`Viewer.disk_cache` if there is one. """
+        if self.__disk_cache is None or Path(path).suffix.lower() == '.npy':
+            return read_image(path)
+        return self.__disk_cache.load(path)
+
+    def get_image(self, key):
+        """ Get the image of a certain key, which is served from the :prop:`Viewer.cache` if possible. """
+        # The image that is shown should not get evicted by prefetched images
+        owner = self.__pin_owner
+        if owner is not None:
+            self.__cache.pin(key, owner)
+        if self.__prefetcher is not None:
+            return self.__prefetcher.get(key)
+
+        img = self.__cache.get(key)
+        if img is None:
+            img = self.load_image(key)
+            self.__cache.put(key, img)
+        return img
+
+    def _on_prefetch(self, change):
+        # Keep the last navigation direction and step size
+        delta = change['new'] - change['old']
+        if delta != 0:
+            self.__direction = (1 if delta > 0 else -1, abs(delta))
+        direction, step = self.__direction
+
+        current = self.image_key(change['new'])
+        if current is None:
+            return
+
+        keys = []
+        for i in range(1, self.__prefetch + 1):
+            index = change['new'] + direction * step * i
+            if not 0 <= index < self.__w_idx.total:
+                break
+
+            key = self.image_key(index)
+            if key != current and key not in keys:
+                keys.append(key)
+
+        self.__prefetcher.prefetch(keys)
+
     @property
     def header(self):
         """ Returns a tuple with the elements from :meth:`Viewer.__init_header__`. """
@@ -139,12 +376,58 @@ class Viewer(UnlinkBox):
         """ Returns a tuple with the elements from :meth:`Viewer.__init_footer__`. """
         return self.__footer
 
-    def redraw(self):
-        """ Manually fire :meth:`Viewer.on_index`. """
-        self.on_index({
+    @property
+    def cache(self):
+        """ Returns the :class:`~ibb.ImageCache` of this viewer. """
+        return self.__cache
+
+    @property
+    def disk_cache(self):
+        """ Returns the :class:`~ibb.DiskCache` of this viewer or None. """
+        return self.__disk_cache
+
+    def close(self):
+        """ Close the viewer, which stops its background threads and releases the image it pinned in the :prop:`Viewer.cache`. """
+        if self.__scheduled is not None:
+            self.__scheduled.cancel()
+            self.__scheduled = None
+        self.__pending = None
+
+        if self.__executor is not None:
+            # Loads that are still running do not get drawn anymore
+            self.__generation += 1
+            if self.__future is not None:
+                self.__future.cancel()
+                self.__future = None
+            self.__executor.shutdown(wait=False)
+        if self.__prefetcher is not None:
+            self.__prefetcher.shutdown()
+
+        owner, self.__pin_owner = self.__pin_owner, None
+        if owner is not None:
+            self.__cache.pin(None, owner)
+
+        super().close()
+
+    def redraw(self, image=True):
+        """
+        Manually fire :meth:`Viewer.on_index`.
+
+        Args:
+            image (bool): Whether to reload the image or only redraw the overlay with :meth:`Viewer.on_overlay`; Default **True**
+        """
+        if not image:
+            self.on_overlay()
+            return
+
+        change = {
             'new': self.__w_idx.index,
             'old': self.__w_idx.index,
             'type': 'change',
             'name': 'index',
             'owner': self.__w_idx,
-        })
+        }
+
+        self.on_index(change)
+        if self.__prefetcher is not None:
+            self._on_prefetch(change)
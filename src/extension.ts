@@ -13,4 +13,7 @@
 (window as any).__webpack_public_path__ = document.querySelector('body')!.getAttribute('data-base-url') + 'nbextensions/ibb';
 /* eslint-enable */
 
+// Webpack resolves the render worker script from the public path of this bundle
+__webpack_public_path__ = (window as any).__webpack_public_path__ + '/';
+
 export * from './index';
@@ -3,9 +3,11 @@
 
 import { DOMWidgetModel, DOMWidgetView, ISerializers } from '@jupyter-widgets/base';
 
-import type { Polygon, PolyStyle } from './polygons';
-import { centroid_polygon, inside_polygon, area_polygon } from './polygons';
-import { serialize_numpy, deserialize_numpy } from './serializers';
+import type { Polygon } from './polygons';
+import type { RenderMessage, RenderMethod, RenderSettings } from './renderer';
+import { CanvasRenderer } from './renderer';
+import type { CanvasImage } from './serializers';
+import { serialize_numpy, deserialize_numpy, deserialize_polygons, deserialize_mask } from './serializers';
 import { MODULE_NAME, MODULE_VERSION } from './version';
 
 export class ImageCanvasModel extends DOMWidgetModel {
@@ -24,6 +26,8 @@ export class ImageCanvasModel extends DOMWidgetModel {
   static serializers: ISerializers = {
     ...DOMWidgetModel.serializers,
     image: { serialize: serialize_numpy, deserialize: deserialize_numpy },
+    polygons: { deserialize: deserialize_polygons },
+    visible: { deserialize: deserialize_mask },
   };
 
   static model_name = 'ImageCanvasModel';
@@ -34,43 +38,52 @@ export class ImageCanvasModel extends DOMWidgetModel {
   static view_module_version = MODULE_VERSION;
 }
 
+/**
+ * Check whether the browser can render canvases in a Web Worker.
+ */
+function supports_render_worker(): boolean {
+  return typeof Worker !== 'undefined' && typeof HTMLCanvasElement !== 'undefined' && 'transferControlToOffscreen' in HTMLCanvasElement.prototype;
+}
+
 export class ImageCanvasView extends DOMWidgetView {
   private POLY: boolean;
-  private ENLARGE: boolean;
-  private COLOR: string;
-  private ALPHA: string;
-  private SIZE: number;
-  private HOVER: PolyStyle;
-  private CLICK: PolyStyle;
+  private OFFSCREEN: boolean;
+  private SETTINGS: RenderSettings;
 
   private bg: HTMLCanvasElement;
   private fg: HTMLCanvasElement;
   private fx: HTMLCanvasElement;
-  private poly: Polygon[];
+  private poly: Polygon[] | null = null;
+  private hovered: number | null = null;
+  private hover_timer: number | null = null;
+  private hover_sent = 0;
 
-  private scale: number;
-  private offset_x: number;
-  private offset_y: number;
+  private renderer: CanvasRenderer | null = null;
+  private worker: Worker | null = null;
+  private worker_queue: Promise<void> = Promise.resolve();
 
   render() {
     // Constants
     this.POLY = this.model.get('enable_poly');
-    this.ENLARGE = this.model.get('enlarge');
-    this.COLOR = this.model.get('color');
-    this.ALPHA = this.model.get('alpha');
-    this.SIZE = this.model.get('size');
-    this.HOVER = this.model.get('hover_style');
-    this.CLICK = this.model.get('click_style');
+    this.OFFSCREEN = this.model.get('offscreen') && supports_render_worker();
+    this.SETTINGS = {
+      enlarge: this.model.get('enlarge'),
+      color: this.model.get('color'),
+      alpha: this.model.get('alpha'),
+      size: this.model.get('size'),
+      hover: this.model.get('hover_style'),
+      click: this.model.get('click_style'),
+    };
 
     // PY -> JS
     this.model.on('change:image', this.draw_image, this);
     this.model.on('change:save', this.save, this);
     if (this.POLY) {
       this.model.on('change:polygons', this.draw_polygons, this);
-      if (this.HOVER !== null) {
-        this.model.on('change:hovered', this.draw_fx, this);
-      }
-      if (this.CLICK !== null) {
+      this.model.on('change:visible', this.draw_visible, this);
+      this.model.on('change:alt_coords', this.draw_visible, this);
+      this.model.on('change:hovered', this.change_hovered, this);
+      if (this.SETTINGS.click !== null) {
         this.model.on('change:clicked', this.draw_fx, this);
       }
     }
@@ -105,10 +118,7 @@ export class ImageCanvasView extends DOMWidgetView {
       this.fx.style.bottom = '1px';
       this.fx.onclick = this.onclick.bind(this);
       this.fx.onmousemove = this.onhover.bind(this);
-      this.fx.onmouseleave = () => {
-        this.model.set('hovered', null);
-        this.touch();
-      };
+      this.fx.onmouseleave = () => this.set_hovered(null);
     }
 
     // Add to DOM
@@ -122,6 +132,12 @@ export class ImageCanvasView extends DOMWidgetView {
       this.el.appendChild(this.fx);
     }
 
+    // Renderer
+    if (!this.OFFSCREEN || !this.create_worker()) {
+      const scratch = document.createElement('canvas');
+      this.renderer = new CanvasRenderer(this.bg, this.POLY ? this.fg : null, this.POLY ? this.fx : null, this.SETTINGS, scratch);
+    }
+
     // Resize Observer
     const observer = new ResizeObserver(([entry]) => this.draw(entry.contentRect.width, entry.contentRect.height));
     observer.observe(this.el);
@@ -129,138 +145,161 @@ export class ImageCanvasView extends DOMWidgetView {
     // Draw
     const { width, height } = this.bg.getBoundingClientRect();
     this.draw(width, height);
-  }
-
-  draw(width: number, height: number) {
-    this.bg.width = width;
-    this.bg.height = height;
     this.draw_image();
-
     if (this.POLY) {
-      this.fg.width = width;
-      this.fg.height = height;
       this.draw_polygons();
+    }
+  }
 
-      this.fx.width = width;
-      this.fx.height = height;
-      this.draw_fx();
+  create_worker(): boolean {
+    // The worker is a separate script of the bundle, which browsers refuse to start from another origin (eg. the CDN bundle)
+    // Webpack 5 bundles the worker module as a separate chunk when it sees this exact pattern.
+    // The library is compiled to CommonJS, where typescript does not allow import.meta, so it is emitted unchecked.
+    let worker: Worker;
+    try {
+      // eslint-disable-next-line @typescript-eslint/ban-ts-comment
+      // @ts-ignore
+      worker = new Worker(new URL('./renderworker', import.meta.url));
+    } catch (err) {
+      console.warn('Could not start the render worker, rendering on the main thread instead', err);
+      return false;
+    }
+
+    // The canvases are transferred to the worker, which does all the drawing and hit testing
+    const canvases = [this.bg, this.POLY ? this.fg : null, this.POLY ? this.fx : null].map(
+      (canvas) => canvas && (canvas as HTMLCanvasElement & { transferControlToOffscreen(): Transferable }).transferControlToOffscreen()
+    );
+    const transfer = canvases.filter((canvas) => canvas !== null) as Transferable[];
+
+    this.worker = worker;
+    worker.onerror = (err) => console.error('Error in the render worker', err);
+    worker.onmessage = ({ data }) => {
+      if (data.reply === 'hovered') {
+        this.set_hovered(data.result);
+      } else if (data.reply === 'clicked') {
+        this.set_clicked(data.result);
+      } else if (data.reply === 'save') {
+        const url = URL.createObjectURL(data.result);
+        this.open_image(url);
+        setTimeout(() => URL.revokeObjectURL(url), 60000);
+      }
+    };
+    worker.postMessage({ method: 'init', args: [...canvases, this.SETTINGS] }, transfer);
+    return true;
+  }
+
+  remove() {
+    if (this.worker) {
+      this.worker.terminate();
+      this.worker = null;
+    }
+    return super.remove();
+  }
+
+  draw(width: number, height: number) {
+    // Canvas sizes are integers
+    width = Math.floor(width);
+    height = Math.floor(height);
+    this.report_size(width, height);
+    this._render('resize', width, height);
+  }
+
+  report_size(width: number, height: number) {
+    // Let the kernel know the canvas size, so it can downscale images before sending them
+    if (width > 0 && height > 0 && (width !== this.model.get('view_width') || height !== this.model.get('view_height'))) {
+      this.model.set({ view_width: width, view_height: height });
+      this.touch();
     }
   }
 
   draw_image() {
-    const img = this.model.get('image');
-    const width = this.bg.width;
-    const height = this.bg.height;
-    const bgctx = this.bg.getContext('2d');
-    if (!bgctx) {
+    const img: CanvasImage | null = this.model.get('image');
+    if (!this.worker) {
+      this._render('set_image', img);
       return;
     }
 
-    bgctx.clearRect(0, 0, width, height);
-    this.scale = 1;
-    this.offset_x = 0;
-    this.offset_y = 0;
-
-    if (img) {
-      const imgd = new ImageData(img.data, img.shape[1], img.shape[0]);
-
-      if (!this.ENLARGE && img.shape[1] <= width && img.shape[0] <= height) {
-        this.offset_x = Math.floor((width - img.shape[1]) / 2);
-        this.offset_y = Math.floor((height - img.shape[0]) / 2);
-        bgctx.putImageData(imgd, this.offset_x, this.offset_y);
-      } else {
-        const oc = document.createElement('canvas'),
-          octx = oc.getContext('2d');
-        if (!octx) {
-          return;
-        }
-
-        // Compute scale and offset
-        this.scale = Math.min(width / img.shape[1], height / img.shape[0]);
-        const scaled_w = img.shape[1] * this.scale;
-        const scaled_h = img.shape[0] * this.scale;
+    // The worker gets its own copy of the image as an ImageBitmap, so that the model keeps its data
+    let bitmap: Promise<ImageBitmap | null> = Promise.resolve(null);
+    if (img && img.bitmap) {
+      bitmap = createImageBitmap(img.bitmap);
+    } else if (img && img.data) {
+      bitmap = createImageBitmap(new ImageData(img.data, img.shape[1], img.shape[0]));
+    }
 
-        this.offset_x = Math.floor((width - scaled_w) / 2);
-        this.offset_y = Math.floor((height - scaled_h) / 2);
+    this._post(
+      bitmap.then((bitmap): [RenderMessage, Transferable[]] => {
+        const image = img && bitmap ? { bitmap, shape: img.shape, source_shape: img.source_shape } : null;
+        return [{ method: 'set_image', args: [image] }, bitmap ? [bitmap] : []];
+      })
+    );
+  }
 
-        // Draw original image
-        oc.width = img.shape[1];
-        oc.height = img.shape[0];
-        octx.putImageData(imgd, 0, 0);
+  draw_polygons() {
+    const polygons: Polygon[] | null = this.model.get('polygons');
+    const alt = this.model.get('alt_coords');
+    this.poly = polygons && alt ? polygons.map((poly) => (poly.alt_coords ? { ...poly, coords: poly.alt_coords } : poly)) : polygons;
 
-        // Draw rescaled image
-        bgctx.drawImage(oc, 0, 0, img.shape[1], img.shape[0], this.offset_x, this.offset_y, scaled_w, scaled_h);
-      }
+    // The kernel does not know about the hovered polygon, so we need to reset it ourselves
+    if (!this.model.get('sync_hover')) {
+      this.hovered = null;
+      this.draw_fx();
     }
+
+    this._render('set_polygons', this.poly, this.model.get('visible'));
   }
 
-  draw_polygons() {
-    this.poly = this.model.get('polygons');
-    const fgctx = this.fg.getContext('2d');
-    if (!fgctx) {
+  draw_visible() {
+    // Polygons and visibility/alt_coords changed together, which is handled in draw_polygons
+    if (this.model.hasChanged('polygons')) {
       return;
     }
 
-    fgctx.clearRect(0, 0, this.fg.width, this.fg.height);
-    if (this.poly) {
-      this.poly.forEach((poly) => {
-        this._draw_poly(fgctx as CanvasRenderingContext2D, poly);
-      });
+    // Only the visibility or coordinate representation changed, so we redraw the polygons we already have
+    if (this.model.hasChanged('alt_coords')) {
+      this.draw_polygons();
+    } else {
+      this._render('set_visible', this.model.get('visible'));
     }
   }
 
-  draw_fx() {
-    const hover_idx = this.model.get('hovered');
-    const click_idx = this.model.get('clicked');
-    const fxctx = this.fx.getContext('2d');
-    if (!fxctx) {
+  change_hovered() {
+    // Changes from the kernel overrule any pending hovered update of the view
+    const hovered = this.model.get('hovered');
+    if (hovered === this.hovered) {
       return;
     }
 
-    fxctx.clearRect(0, 0, this.fx.width, this.fx.height);
-    if (this.poly) {
-      if (click_idx !== null && click_idx < this.poly.length) {
-        this._draw_poly(fxctx, this.poly[click_idx], this.CLICK);
-      }
-      if (hover_idx !== null && hover_idx < this.poly.length) {
-        this._draw_poly(fxctx, this.poly[hover_idx], this.HOVER, true);
-      }
+    this.hovered = hovered;
+    this._cancel_hover_sync();
+    if (this.SETTINGS.hover !== null) {
+      this.draw_fx();
     }
   }
 
+  draw_fx() {
+    this._render('set_fx', this.hovered, this.model.get('clicked'));
+  }
+
   save() {
     const save_val = this.model.get('save');
 
     if (save_val) {
-      const { width, height } = this.bg.getBoundingClientRect();
-
-      const result = document.createElement('canvas');
-      result.width = width;
-      result.height = height;
-      const ctx = result.getContext('2d');
-      if (!ctx) {
-        return;
-      }
-
-      // Clear result canvas
-      ctx.clearRect(0, 0, width, height);
+      if (this.worker) {
+        this._post({ method: 'save', args: [], reply: 'save' });
+      } else if (this.renderer) {
+        const result = document.createElement('canvas');
+        result.width = this.renderer.bg.width;
+        result.height = this.renderer.bg.height;
+        const ctx = result.getContext('2d');
+        if (!ctx) {
+          return;
+        }
 
-      // Draw canvases
-      ctx.drawImage(this.bg, 0, 0, width, height);
-      if (this.POLY) {
-        ctx.drawImage(this.fg, 0, 0, width, height);
-        ctx.drawImage(this.fx, 0, 0, width, height);
+        this.renderer.compose(ctx);
+        this.open_image(result.toDataURL('png'));
       }
 
-      // Open in new tab
-      const data = result.toDataURL('png');
-      const w = window.open('about:blank');
-      setTimeout(() => {
-        if (w) {
-          w.document.body.appendChild(w.document.createElement('img')).src = data;
-        }
-      }, 0);
-
       // Reset save
       setTimeout(() => {
         this.model.set('save', false);
@@ -269,120 +308,117 @@ export class ImageCanvasView extends DOMWidgetView {
     }
   }
 
+  open_image(src: string) {
+    // Open in new tab
+    const w = window.open('about:blank');
+    setTimeout(() => {
+      if (w) {
+        w.document.body.appendChild(w.document.createElement('img')).src = src;
+      }
+    }, 0);
+  }
+
   onclick(e: MouseEvent) {
     if (this.model.comm_live) {
-      const [x, y] = this._get_image_coord(e.clientX, e.clientY);
-      this.model.set('clicked', this._get_closest_poly(x, y));
-      this.touch();
+      const [x, y] = this._get_canvas_coord(e.clientX, e.clientY);
+      if (this.worker) {
+        this._post({ method: 'closest', args: [x, y], reply: 'clicked' });
+      } else if (this.renderer) {
+        this.set_clicked(this.renderer.closest(x, y));
+      }
     }
   }
 
   onhover(e: MouseEvent) {
-    const [x, y] = this._get_image_coord(e.clientX, e.clientY);
-    this.model.set('hovered', this._get_closest_poly(x, y));
-    this.touch();
+    const [x, y] = this._get_canvas_coord(e.clientX, e.clientY);
+    if (this.worker) {
+      this._post({ method: 'closest', args: [x, y], reply: 'hovered' });
+    } else if (this.renderer) {
+      this.set_hovered(this.renderer.closest(x, y));
+    }
   }
 
-  _draw_poly(ctx: CanvasRenderingContext2D, poly: Polygon, style?: PolyStyle, label = false) {
-    const coords: Polygon['coords'] = poly.coords.map(([x, y]) => [this.offset_x + x * this.scale, this.offset_y + y * this.scale]);
-
-    // Draw
-    ctx.beginPath();
-    ctx.moveTo(coords[0][0], coords[0][1]);
-    for (const [x, y] of coords.slice(1)) {
-      ctx.lineTo(x, y);
+  set_clicked(clicked: number | null) {
+    if (this.model.comm_live && clicked !== this.model.get('clicked')) {
+      this.model.set('clicked', clicked);
+      this.touch();
     }
-    ctx.closePath();
+  }
 
-    // Styles
-    if (style) {
-      ctx.strokeStyle = style.color || poly.color || this.COLOR;
-      ctx.lineWidth = style.size || poly.size || this.SIZE;
-      ctx.fillStyle = ctx.strokeStyle + (style.alpha || poly.alpha || this.ALPHA);
-    } else {
-      ctx.strokeStyle = poly.color || this.COLOR;
-      ctx.lineWidth = poly.size || this.SIZE;
-      ctx.fillStyle = ctx.strokeStyle + (poly.alpha || this.ALPHA);
+  set_hovered(hovered: number | null) {
+    // Only changes are drawn and sent to the kernel
+    if (hovered === this.hovered) {
+      return;
     }
 
-    ctx.stroke();
-    ctx.fill();
-
-    // Text
-    if (label && poly.label) {
-      const centroid = centroid_polygon({ coords });
-
-      ctx.font = '14px sans-serif';
-      ctx.textBaseline = 'middle';
-      ctx.textAlign = 'center';
-      ctx.fillStyle = ctx.strokeStyle;
-      ctx.strokeStyle = 'white';
-      ctx.lineWidth = 4;
-
-      ctx.strokeText(poly.label, ...centroid);
-      ctx.fillText(poly.label, ...centroid);
+    this.hovered = hovered;
+    if (this.SETTINGS.hover !== null) {
+      this.draw_fx();
+    }
+    if (this.model.get('sync_hover')) {
+      this._sync_hovered();
     }
   }
 
-  _get_image_coord(x: number, y: number) {
-    const r = this.fx.getBoundingClientRect();
-
-    x -= r.left + this.offset_x;
-    y -= r.top + this.offset_y;
-
-    x /= this.scale;
-    y /= this.scale;
+  _sync_hovered() {
+    // Rate limit the hovered updates, but always send the last value
+    if (this.hover_timer !== null) {
+      return;
+    }
 
-    return [x, y];
+    const rate = this.model.get('sync_rate');
+    const wait = rate > 0 ? this.hover_sent + 1000 / rate - performance.now() : 0;
+    if (wait > 0) {
+      this.hover_timer = window.setTimeout(() => {
+        this.hover_timer = null;
+        this._send_hovered();
+      }, wait);
+    } else {
+      this._send_hovered();
+    }
   }
 
-  _get_closest_poly(x: number, y: number) {
-    if (this.poly === null || this.poly.length === 0) {
-      return null;
+  _send_hovered() {
+    this.hover_sent = performance.now();
+    if (this.hovered !== this.model.get('hovered')) {
+      this.model.set('hovered', this.hovered);
+      this.touch();
     }
+  }
 
-    type IndexedPolygon = {
-      idx: number;
-      poly: Polygon;
-    };
-    type SmallestPolygon = IndexedPolygon & { area: number };
-    type ClosestPolygon = SmallestPolygon & { distance: number };
-
-    const candidate = this.poly
-      // Remember original index
-      .map((poly, idx) => {
-        return { idx, poly };
-      })
-
-      // Filter boxes based on mouse position
-      .filter(({ poly }) => inside_polygon([x, y], poly))
-
-      // Reduce to find smallest box
-      .reduce((smallest: SmallestPolygon[], current) => {
-        const area = area_polygon(current.poly);
-
-        if (smallest.length === 0 || area < smallest[0].area) {
-          return [{ ...current, area }];
-        } else if (area === smallest[0].area) {
-          return [...smallest, { ...current, area }];
-        }
-        return smallest;
-      }, [])
+  _cancel_hover_sync() {
+    if (this.hover_timer !== null) {
+      window.clearTimeout(this.hover_timer);
+      this.hover_timer = null;
+    }
+  }
 
-      // Reduce to position closest to center
-      .reduce((closest: ClosestPolygon | null, current: SmallestPolygon) => {
-        const [cx, cy] = centroid_polygon(current.poly);
-        const distance = Math.sqrt(Math.pow(x - cx, 2) + Math.pow(y - cy, 2));
+  _render<M extends RenderMethod>(method: M, ...args: Parameters<CanvasRenderer[M]>) {
+    // Run a renderer method on the main thread or in the worker
+    if (this.worker) {
+      this._post({ method, args });
+    } else if (this.renderer) {
+      Reflect.apply(this.renderer[method], this.renderer, args);
+    }
+  }
 
-        if (closest === null || distance < closest.distance) {
-          return { ...current, distance };
+  _post(message: RenderMessage | Promise<[RenderMessage, Transferable[]]>) {
+    // Messages are chained, so they arrive in order even if some need to wait for an ImageBitmap
+    const worker = this.worker as Worker;
+    this.worker_queue = this.worker_queue
+      .then(() => message)
+      .then((message) => {
+        if (Array.isArray(message)) {
+          worker.postMessage(...message);
+        } else {
+          worker.postMessage(message);
         }
-        return closest;
-      }, null);
+      })
+      .catch((err) => console.error('Could not send data to the render worker', err));
+  }
 
-    if (candidate === null) {
-      return null;
-    }
-    return candidate.idx;
+  _get_canvas_coord(x: number, y: number) {
+    const r = this.fx.getBoundingClientRect();
+    return [x - r.left, y - r.top];
   }
 }
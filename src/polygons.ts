@@ -7,38 +7,40 @@ export type PolyStyle = {
 export type Coordinate = [number, number];
 
 export type Polygon = PolyStyle & {
-  coords: Coordinate[];
+  coords: Float32Array; // Flat X,Y coordinates
+  alt_coords?: Float32Array; // Alternative representation (eg. segmentation mask instead of bounding box)
   label?: string;
 };
 
 export function centroid_polygon(polygon: Polygon): Coordinate {
   const centroid: Coordinate = [0, 0];
   const { coords } = polygon;
+  const length = coords.length / 2;
 
-  for (const [x, y] of coords) {
-    centroid[0] += x;
-    centroid[1] += y;
+  for (let i = 0; i < coords.length; i += 2) {
+    centroid[0] += coords[i];
+    centroid[1] += coords[i + 1];
   }
 
-  centroid[0] /= coords.length;
-  centroid[1] /= coords.length;
+  centroid[0] /= length;
+  centroid[1] /= length;
 
   return centroid;
 }
 
 export function inside_polygon(point: Coordinate, polygon: Polygon): boolean {
+  return inside_coords(point[0], point[1], polygon.coords);
+}
+
+function inside_coords(x: number, y: number, coords: Float32Array): boolean {
   // ray-casting algorithm based on
   // https://wrf.ecse.rpi.edu/Research/Short_Notes/pnpoly.html/pnpoly.html
-  const x = point[0],
-    y = point[1];
-  const { coords } = polygon;
-
   let inside = false;
-  for (let i = 0, j = coords.length - 1; i < coords.length; j = i++) {
-    const xi = coords[i][0],
-      yi = coords[i][1];
-    const xj = coords[j][0],
-      yj = coords[j][1];
+  for (let i = 0, j = coords.length - 2; i < coords.length; j = i, i += 2) {
+    const xi = coords[i],
+      yi = coords[i + 1];
+    const xj = coords[j],
+      yj = coords[j + 1];
     const intersect = yi > y !== yj > y && x < ((xj - xi) * (y - yi)) / (yj - yi) + xi;
 
     if (intersect) {
@@ -53,10 +55,172 @@ export function area_polygon(polygon: Polygon): number {
   const { coords } = polygon;
   let area = 0;
 
-  for (let i = 0, j = coords.length - 1; i < coords.length; i++) {
-    area += coords[j][0] * coords[i][1] - coords[j][1] * coords[i][0];
-    j = i;
+  for (let i = 0, j = coords.length - 2; i < coords.length; j = i, i += 2) {
+    area += coords[j] * coords[i + 1] - coords[j + 1] * coords[i];
   }
 
   return Math.abs(area / 2);
 }
+
+/**
+ * Uniform grid over the bounding boxes of a list of polygons, to find the polygon under the mouse without checking every polygon.
+ * Bounding boxes, areas and centroids are computed once when building the index,
+ * and the cells are stored as flat arrays (CSR layout) so that queries do not allocate.
+ */
+export class PolygonIndex {
+  private polygons: Polygon[];
+  private bounds: Float32Array; // x0, y0, x1, y1 per polygon
+  private areas: Float64Array;
+  private centroids: Float64Array; // cx, cy per polygon
+
+  private x0 = 0;
+  private y0 = 0;
+  private cell_size = 1;
+  private cols = 0;
+  private rows = 0;
+  private cell_start: Uint32Array; // Start of each cell in cell_items (length cols * rows + 1)
+  private cell_items: Uint32Array; // Polygon indices, sorted per cell
+
+  constructor(polygons: Polygon[], max_cells = 128 * 128) {
+    const length = polygons.length;
+    this.polygons = polygons;
+    this.bounds = new Float32Array(length * 4);
+    this.areas = new Float64Array(length);
+    this.centroids = new Float64Array(length * 2);
+
+    // Polygon metadata
+    let min_x = Infinity,
+      min_y = Infinity,
+      max_x = -Infinity,
+      max_y = -Infinity,
+      total_area = 0;
+    polygons.forEach((poly, idx) => {
+      const { coords } = poly;
+      let x0 = Infinity,
+        y0 = Infinity,
+        x1 = -Infinity,
+        y1 = -Infinity;
+      for (let i = 0; i < coords.length; i += 2) {
+        x0 = Math.min(x0, coords[i]);
+        x1 = Math.max(x1, coords[i]);
+        y0 = Math.min(y0, coords[i + 1]);
+        y1 = Math.max(y1, coords[i + 1]);
+      }
+      this.bounds.set([x0, y0, x1, y1], idx * 4);
+      this.areas[idx] = area_polygon(poly);
+      this.centroids.set(coords.length ? centroid_polygon(poly) : [NaN, NaN], idx * 2);
+
+      if (coords.length) {
+        min_x = Math.min(min_x, x0);
+        min_y = Math.min(min_y, y0);
+        max_x = Math.max(max_x, x1);
+        max_y = Math.max(max_y, y1);
+        total_area += (x1 - x0) * (y1 - y0);
+      }
+    });
+
+    if (min_x > max_x) {
+      this.cell_start = new Uint32Array(1);
+      this.cell_items = new Uint32Array(0);
+      return;
+    }
+
+    // Grid with about one (average sized) polygon per cell
+    const width = max_x - min_x,
+      height = max_y - min_y;
+    this.x0 = min_x;
+    this.y0 = min_y;
+    this.cell_size = Math.max(
+      Math.sqrt(total_area / length),
+      Math.sqrt((width * height) / max_cells),
+      width / Math.sqrt(max_cells),
+      height / Math.sqrt(max_cells),
+      1e-6
+    );
+    this.cols = Math.floor(width / this.cell_size) + 1;
+    this.rows = Math.floor(height / this.cell_size) + 1;
+
+    // Count items per cell, then fill them in polygon order
+    const counts = new Uint32Array(this.cols * this.rows + 1);
+    this._each_cell((cell) => counts[cell + 1]++);
+    for (let i = 1; i < counts.length; i++) {
+      counts[i] += counts[i - 1];
+    }
+    this.cell_start = counts.slice();
+    this.cell_items = new Uint32Array(counts[counts.length - 1]);
+    this._each_cell((cell, idx) => {
+      this.cell_items[counts[cell]++] = idx;
+    });
+  }
+
+  /**
+   * Return the index of the smallest visible polygon that contains the point.
+   * Polygons with the same area are resolved by picking the one whose centroid is closest to the point.
+   */
+  query(x: number, y: number, visible: Uint8Array | null = null): number | null {
+    const col = Math.floor((x - this.x0) / this.cell_size),
+      row = Math.floor((y - this.y0) / this.cell_size);
+    if (col < 0 || row < 0 || col >= this.cols || row >= this.rows) {
+      return null;
+    }
+
+    const cell = row * this.cols + col;
+    let closest: number | null = null,
+      closest_area = Infinity,
+      closest_distance = Infinity;
+
+    for (let i = this.cell_start[cell]; i < this.cell_start[cell + 1]; i++) {
+      const idx = this.cell_items[i];
+      if (visible && idx < visible.length && visible[idx] === 0) {
+        continue;
+      }
+
+      const area = this.areas[idx];
+      if (area > closest_area) {
+        continue;
+      }
+
+      const b = idx * 4;
+      if (x < this.bounds[b] || y < this.bounds[b + 1] || x > this.bounds[b + 2] || y > this.bounds[b + 3]) {
+        continue;
+      }
+      if (!inside_coords(x, y, this.polygons[idx].coords)) {
+        continue;
+      }
+
+      const dx = x - this.centroids[idx * 2],
+        dy = y - this.centroids[idx * 2 + 1];
+      const distance = Math.sqrt(dx * dx + dy * dy);
+      if (area < closest_area || distance < closest_distance) {
+        closest = idx;
+        closest_area = area;
+        closest_distance = distance;
+      }
+    }
+
+    return closest;
+  }
+
+  centroid(idx: number): Coordinate {
+    return [this.centroids[idx * 2], this.centroids[idx * 2 + 1]];
+  }
+
+  private _each_cell(fn: (cell: number, idx: number) => void) {
+    for (let idx = 0; idx < this.polygons.length; idx++) {
+      if (this.polygons[idx].coords.length === 0) {
+        continue;
+      }
+
+      const b = idx * 4;
+      const c0 = Math.floor((this.bounds[b] - this.x0) / this.cell_size),
+        r0 = Math.floor((this.bounds[b + 1] - this.y0) / this.cell_size),
+        c1 = Math.floor((this.bounds[b + 2] - this.x0) / this.cell_size),
+        r1 = Math.floor((this.bounds[b + 3] - this.y0) / this.cell_size);
+      for (let r = r0; r <= r1; r++) {
+        for (let c = c0; c <= c1; c++) {
+          fn(r * this.cols + c, idx);
+        }
+      }
+    }
+  }
+}
@@ -0,0 +1,339 @@
+// Copyright (c) 0phoff
+// Distributed under the terms of the Modified BSD License.
+
+import type { Polygon, PolyStyle } from './polygons';
+import { PolygonIndex } from './polygons';
+import type { CanvasImage } from './serializers';
+
+/**
+ * Minimal canvas interface, which is implemented by both HTMLCanvasElement and OffscreenCanvas.
+ */
+export type RenderCanvas = {
+  width: number;
+  height: number;
+  getContext(contextId: '2d'): CanvasRenderingContext2D | null;
+};
+
+export type RenderMethod = 'resize' | 'set_image' | 'set_polygons' | 'set_visible' | 'set_fx' | 'closest';
+
+export type RenderMessage = {
+  method: RenderMethod | 'init' | 'save';
+  args: unknown[];
+  reply?: string; // If set, the result gets posted back with this name
+};
+
+export type RenderSettings = {
+  enlarge: boolean;
+  color: string;
+  alpha: string;
+  size: number;
+  hover: PolyStyle | null;
+  click: PolyStyle | null;
+};
+
+type PolyBatch = {
+  color: string;
+  size: number;
+  alpha: string;
+  path: Path2D; // All polygons of the batch, to stroke them at once
+  fills: Path2D[]; // Individual polygons, which are filled separately so overlapping fills blend like before
+};
+
+/**
+ * Draws the image, polygons and hover/click effects of an ImageCanvas on three stacked canvases.
+ *
+ * The renderer only uses the canvas API and does not depend on the widget model or the document,
+ * so that it can run both on the main thread and in a Web Worker with OffscreenCanvas (see renderworker.ts).
+ * The scratch canvas is used to rescale raw image data and should be created by the caller (eg. with `document.createElement` or `new OffscreenCanvas`).
+ */
+export class CanvasRenderer {
+  image: CanvasImage | null = null;
+  poly: Polygon[] | null = null;
+  visible: Uint8Array | null = null;
+  hovered: number | null = null;
+  clicked: number | null = null;
+
+  scale = 1;
+  offset_x = 0;
+  offset_y = 0;
+
+  private poly_index: PolygonIndex | null = null;
+  private poly_paths: (Path2D | null)[] = [];
+  private poly_batches: PolyBatch[] | null = null;
+
+  constructor(
+    readonly bg: RenderCanvas,
+    private fg: RenderCanvas | null,
+    private fx: RenderCanvas | null,
+    private settings: RenderSettings,
+    private scratch: RenderCanvas
+  ) {}
+
+  resize(width: number, height: number) {
+    this.bg.width = width;
+    this.bg.height = height;
+    this.draw_image();
+
+    if (this.fg && this.fx) {
+      this.fg.width = width;
+      this.fg.height = height;
+      this.draw_polygons();
+
+      this.fx.width = width;
+      this.fx.height = height;
+      this.draw_fx();
+    }
+  }
+
+  set_image(image: CanvasImage | null) {
+    this.image = image;
+    this.draw_image();
+  }
+
+  set_polygons(poly: Polygon[] | null, visible: Uint8Array | null) {
+    this.poly = poly;
+    this.visible = visible;
+    this.poly_index = null;
+    this.poly_paths = [];
+    this.poly_batches = null;
+    this.draw_polygons();
+    this.draw_fx();
+  }
+
+  set_visible(visible: Uint8Array | null) {
+    this.visible = visible;
+    this.poly_batches = null;
+    this.draw_polygons();
+    this.draw_fx();
+  }
+
+  set_fx(hovered: number | null, clicked: number | null) {
+    this.hovered = hovered;
+    this.clicked = clicked;
+    this.draw_fx();
+  }
+
+  draw_image() {
+    const img = this.image;
+    const width = this.bg.width;
+    const height = this.bg.height;
+    const bgctx = this.bg.getContext('2d');
+    if (!bgctx) {
+      return;
+    }
+
+    bgctx.clearRect(0, 0, width, height);
+    this.scale = 1;
+    this.offset_x = 0;
+    this.offset_y = 0;
+
+    if (img) {
+      // Image might be downscaled in the kernel, so we compute everything w.r.t. the source shape
+      const [src_h, src_w] = img.source_shape;
+      const [img_h, img_w] = img.shape;
+
+      if (img.data && !this.settings.enlarge && src_w <= width && src_h <= height && img_w === src_w && img_h === src_h) {
+        const imgd = new ImageData(img.data, img_w, img_h);
+        this.offset_x = Math.floor((width - src_w) / 2);
+        this.offset_y = Math.floor((height - src_h) / 2);
+        bgctx.putImageData(imgd, this.offset_x, this.offset_y);
+      } else {
+        // Compute scale and offset
+        this.scale = Math.min(width / src_w, height / src_h);
+        if (!this.settings.enlarge) {
+          this.scale = Math.min(this.scale, 1);
+        }
+        const scaled_w = src_w * this.scale;
+        const scaled_h = src_h * this.scale;
+
+        this.offset_x = Math.floor((width - scaled_w) / 2);
+        this.offset_y = Math.floor((height - scaled_h) / 2);
+
+        // Draw original image
+        let source: CanvasImageSource;
+        if (img.bitmap) {
+          source = img.bitmap;
+        } else if (img.data) {
+          const oc = this.scratch;
+          oc.width = img_w;
+          oc.height = img_h;
+          const octx = oc.getContext('2d');
+          if (!octx) {
+            return;
+          }
+
+          octx.putImageData(new ImageData(img.data, img_w, img_h), 0, 0);
+          source = oc as unknown as CanvasImageSource;
+        } else {
+          return;
+        }
+
+        // Draw rescaled image
+        bgctx.drawImage(source, 0, 0, img_w, img_h, this.offset_x, this.offset_y, scaled_w, scaled_h);
+      }
+    }
+  }
+
+  draw_polygons() {
+    const fgctx = this.fg && this.fg.getContext('2d');
+    if (!this.fg || !fgctx) {
+      return;
+    }
+
+    fgctx.setTransform(1, 0, 0, 1, 0, 0);
+    fgctx.clearRect(0, 0, this.fg.width, this.fg.height);
+    if (this.poly && this.scale > 0) {
+      // Paths are in image coordinates, so resizing only changes the transform
+      fgctx.setTransform(this.scale, 0, 0, this.scale, this.offset_x, this.offset_y);
+      this._get_batches().forEach(({ color, size, alpha, path, fills }) => {
+        this._paint(fgctx as CanvasRenderingContext2D, path, fills, color, size, alpha);
+      });
+      fgctx.setTransform(1, 0, 0, 1, 0, 0);
+    }
+  }
+
+  draw_fx() {
+    const fxctx = this.fx && this.fx.getContext('2d');
+    if (!this.fx || !fxctx) {
+      return;
+    }
+
+    fxctx.clearRect(0, 0, this.fx.width, this.fx.height);
+    if (this.poly) {
+      const { hovered, clicked } = this;
+      if (clicked !== null && clicked < this.poly.length && this._is_visible(clicked)) {
+        this._draw_poly(fxctx, clicked, this.settings.click);
+      }
+      if (hovered !== null && hovered < this.poly.length && this._is_visible(hovered)) {
+        this._draw_poly(fxctx, hovered, this.settings.hover, true);
+      }
+    }
+  }
+
+  /**
+   * Draw all canvases on top of each other in the given context (eg. to save the result as an image).
+   */
+  compose(ctx: CanvasRenderingContext2D) {
+    const { width, height } = this.bg;
+    ctx.clearRect(0, 0, width, height);
+    [this.bg, this.fg, this.fx].forEach((canvas) => {
+      if (canvas) {
+        ctx.drawImage(canvas as unknown as CanvasImageSource, 0, 0, width, height);
+      }
+    });
+  }
+
+  /**
+   * Return the index of the polygon at the given canvas coordinates.
+   */
+  closest(x: number, y: number) {
+    if (this.poly === null || this.poly.length === 0 || !(this.scale > 0)) {
+      return null;
+    }
+
+    return this._get_index().query((x - this.offset_x) / this.scale, (y - this.offset_y) / this.scale, this.visible);
+  }
+
+  _draw_poly(ctx: CanvasRenderingContext2D, idx: number, style: PolyStyle | null, label = false) {
+    const poly = (this.poly as Polygon[])[idx];
+    const path = this._get_path(idx);
+    if (path === null || !(this.scale > 0)) {
+      return;
+    }
+
+    // Draw
+    const { color, size, alpha } = style || ({} as PolyStyle);
+    const { settings } = this;
+    ctx.setTransform(this.scale, 0, 0, this.scale, this.offset_x, this.offset_y);
+    this._paint(ctx, path, [path], color || poly.color || settings.color, size || poly.size || settings.size, alpha || poly.alpha || settings.alpha);
+    ctx.setTransform(1, 0, 0, 1, 0, 0);
+
+    // Text
+    if (label && poly.label) {
+      const [cx, cy] = this._get_index().centroid(idx);
+      const centroid: [number, number] = [this.offset_x + cx * this.scale, this.offset_y + cy * this.scale];
+
+      ctx.font = '14px sans-serif';
+      ctx.textBaseline = 'middle';
+      ctx.textAlign = 'center';
+      ctx.fillStyle = ctx.strokeStyle;
+      ctx.strokeStyle = 'white';
+      ctx.lineWidth = 4;
+
+      ctx.strokeText(poly.label, ...centroid);
+      ctx.fillText(poly.label, ...centroid);
+    }
+  }
+
+  _paint(ctx: CanvasRenderingContext2D, path: Path2D, fills: Path2D[], color: string, size: number, alpha: string) {
+    // The line width gets scaled by the transform as well, so we compensate for it
+    ctx.strokeStyle = color;
+    ctx.lineWidth = size / this.scale;
+    ctx.stroke(path);
+
+    // Fully transparent fills are skipped
+    if (parseInt(alpha, 16) !== 0) {
+      ctx.fillStyle = ctx.strokeStyle + alpha;
+      fills.forEach((fill) => ctx.fill(fill));
+    }
+  }
+
+  _get_index() {
+    // The index is built lazily, so polygons that are never hovered do not pay for it
+    if (this.poly_index === null) {
+      this.poly_index = new PolygonIndex(this.poly || []);
+    }
+    return this.poly_index;
+  }
+
+  _get_path(idx: number) {
+    // Paths are created once per polygon in image coordinates
+    let path = this.poly_paths[idx];
+    if (path === undefined) {
+      const { coords } = (this.poly as Polygon[])[idx];
+      path = null;
+      if (coords.length > 0) {
+        path = new Path2D();
+        path.moveTo(coords[0], coords[1]);
+        for (let i = 2; i < coords.length; i += 2) {
+          path.lineTo(coords[i], coords[i + 1]);
+        }
+        path.closePath();
+      }
+      this.poly_paths[idx] = path;
+    }
+    return path;
+  }
+
+  _get_batches() {
+    // Group the visible polygons per style, so that each group can be stroked with a single call
+    if (this.poly_batches === null) {
+      const batches = new Map<string, PolyBatch>();
+      const { settings } = this;
+      (this.poly || []).forEach((poly, idx) => {
+        const path = this._get_path(idx);
+        if (path === null || !this._is_visible(idx)) {
+          return;
+        }
+
+        const color = poly.color || settings.color;
+        const size = poly.size || settings.size;
+        const alpha = poly.alpha || settings.alpha;
+        const key = `${color}|${size}|${alpha}`;
+        let batch = batches.get(key);
+        if (batch === undefined) {
+          batch = { color, size, alpha, path: new Path2D(), fills: [] };
+          batches.set(key, batch);
+        }
+        batch.path.addPath(path);
+        batch.fills.push(path);
+      });
+      this.poly_batches = [...batches.values()];
+    }
+    return this.poly_batches;
+  }
+
+  _is_visible(idx: number) {
+    return !this.visible || idx >= this.visible.length || this.visible[idx] !== 0;
+  }
+}
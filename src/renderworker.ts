@@ -0,0 +1,45 @@
+// Copyright (c) 0phoff
+// Distributed under the terms of the Modified BSD License.
+
+// Entry point of the render worker of the ImageCanvas (see ImageCanvasView.create_worker).
+//
+// Webpack bundles this module as a separate worker script, which gets loaded from the public path of the bundle.
+
+import type { RenderCanvas, RenderMessage, RenderSettings } from './renderer';
+import { CanvasRenderer } from './renderer';
+
+type OffscreenCanvasLike = RenderCanvas & {
+  convertToBlob(options?: { type?: string }): Promise<Blob>;
+};
+
+type RenderWorkerScope = {
+  onmessage: ((e: MessageEvent) => void) | null;
+  postMessage(message: unknown): void;
+  OffscreenCanvas: new (width: number, height: number) => OffscreenCanvasLike;
+};
+
+const scope = self as unknown as RenderWorkerScope;
+let renderer: CanvasRenderer | null = null;
+
+scope.onmessage = (e: MessageEvent) => {
+  const { method, args, reply }: RenderMessage = e.data;
+
+  if (method === 'init') {
+    const [bg, fg, fx, settings] = args as [RenderCanvas, RenderCanvas | null, RenderCanvas | null, RenderSettings];
+    renderer = new CanvasRenderer(bg, fg, fx, settings, new scope.OffscreenCanvas(1, 1));
+  } else if (renderer === null) {
+    return;
+  } else if (method === 'save') {
+    const result = new scope.OffscreenCanvas(renderer.bg.width, renderer.bg.height);
+    const ctx = result.getContext('2d');
+    if (ctx) {
+      renderer.compose(ctx);
+      result.convertToBlob({ type: 'image/png' }).then((blob) => scope.postMessage({ reply, result: blob }));
+    }
+  } else {
+    const result = Reflect.apply(renderer[method], renderer, args);
+    if (reply) {
+      scope.postMessage({ reply, result });
+    }
+  }
+};
@@ -1,19 +1,121 @@
+import type { Polygon } from './polygons';
+
 type NumpyData = {
-  data: { buffer: Iterable<number> };
+  data: DataView;
+  shape: number[];
+  source_shape?: number[];
+  format?: string;
+};
+
+export type CanvasImage = {
+  data?: Uint8ClampedArray;
+  bitmap?: ImageBitmap;
   shape: number[];
+  source_shape: number[];
+};
+
+type MaskData = {
+  data: DataView;
+  shape: number[];
+};
+
+type PolygonData = {
+  coords: DataView;
+  offsets: DataView;
+  alt_coords?: DataView;
+  alt_offsets?: DataView;
+  palette: string[];
+  color: DataView;
+  size: DataView;
+  alpha: DataView;
+  label: (string | null)[];
 };
 
-export function deserialize_numpy(data: NumpyData) {
+export function deserialize_numpy(data: NumpyData): CanvasImage | Promise<CanvasImage> | null {
   if (data === null) {
     return null;
   }
 
+  // Encoded images (PNG, JPEG, WebP, ...) get decoded by the browser
+  if (data.format) {
+    const blob = new Blob([data.data], { type: data.format });
+    return createImageBitmap(blob).then((bitmap) => ({
+      bitmap,
+      shape: [bitmap.height, bitmap.width],
+      source_shape: data.source_shape || data.shape,
+    }));
+  }
+
   return {
-    data: new Uint8ClampedArray(data.data.buffer),
-    shape: data.shape,
+    data: expand_rgba(data.data, data.shape[0] * data.shape[1], data.shape[2] || 4),
+    shape: data.shape.slice(0, 2),
+    source_shape: data.source_shape || data.shape,
   };
 }
 
+function expand_rgba(data: DataView, pixels: number, channels: number): Uint8ClampedArray {
+  const src = new Uint8ClampedArray(data.buffer, data.byteOffset, pixels * channels);
+  if (channels === 4) {
+    return src;
+  }
+
+  // Grayscale and RGB data is sent as is, so we expand it to RGBA here
+  const dst = new Uint8ClampedArray(pixels * 4);
+  if (channels === 1) {
+    for (let i = 0, j = 0; i < pixels; i++, j += 4) {
+      dst[j] = dst[j + 1] = dst[j + 2] = src[i];
+      dst[j + 3] = 255;
+    }
+  } else {
+    for (let i = 0, j = 0; i < src.length; i += 3, j += 4) {
+      dst[j] = src[i];
+      dst[j + 1] = src[i + 1];
+      dst[j + 2] = src[i + 2];
+      dst[j + 3] = 255;
+    }
+  }
+  return dst;
+}
+
 export function serialize_numpy(data: NumpyData) {
   return data;
 }
+
+export function deserialize_polygons(data: PolygonData | null): Polygon[] | null {
+  if (data === null) {
+    return null;
+  }
+
+  const coords = new Float32Array(data.coords.buffer, data.coords.byteOffset, data.coords.byteLength / 4);
+  const offsets = new Uint32Array(data.offsets.buffer, data.offsets.byteOffset, data.offsets.byteLength / 4);
+  const color = new Uint16Array(data.color.buffer, data.color.byteOffset, data.color.byteLength / 2);
+  const size = new Float32Array(data.size.buffer, data.size.byteOffset, data.size.byteLength / 4);
+  const alpha = new Int16Array(data.alpha.buffer, data.alpha.byteOffset, data.alpha.byteLength / 2);
+
+  const alt_coords = data.alt_coords ? new Float32Array(data.alt_coords.buffer, data.alt_coords.byteOffset, data.alt_coords.byteLength / 4) : null;
+  const alt_offsets = data.alt_offsets ? new Uint32Array(data.alt_offsets.buffer, data.alt_offsets.byteOffset, data.alt_offsets.byteLength / 4) : null;
+
+  const polygons: Polygon[] = new Array(data.label.length);
+  for (let i = 0; i < polygons.length; i++) {
+    polygons[i] = {
+      coords: coords.subarray(2 * offsets[i], 2 * offsets[i + 1]),
+      color: data.palette[color[i]] || undefined,
+      size: size[i] || undefined,
+      alpha: alpha[i] >= 0 ? alpha[i].toString(16).padStart(2, '0') : undefined,
+      label: data.label[i] || undefined,
+    };
+    if (alt_coords && alt_offsets && alt_offsets[i + 1] > alt_offsets[i]) {
+      polygons[i].alt_coords = alt_coords.subarray(2 * alt_offsets[i], 2 * alt_offsets[i + 1]);
+    }
+  }
+
+  return polygons;
+}
+
+export function deserialize_mask(data: MaskData | null): Uint8Array | null {
+  if (data === null) {
+    return null;
+  }
+
+  return new Uint8Array(data.data.buffer, data.data.byteOffset, data.shape[0]);
+}
@@ -0,0 +1,80 @@
+import multiprocessing
+import time
+import pytest
+
+torch = pytest.importorskip('torch')
+from ibb.widgets._torch_viewer import _DataLoaderFetcher  # noqa: E402
+
+
+class CountingDataset(torch.utils.data.Dataset):
+    def __init__(self, length):
+        self.length = length
+        self.loads = multiprocessing.get_context('fork').Value('i', 0)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        with self.loads.get_lock():
+            self.loads.value += 1
+        time.sleep(0.01)
+        return index
+
+
+def get_fetcher(length):
+    data = CountingDataset(length)
+    return data, _DataLoaderFetcher(data, 2, 2, {'multiprocessing_context': 'fork'})
+
+
+def settle(data, timeout=5):
+    """ Wait until the workers stopped loading and return the number of loads. """
+    loads = -1
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        time.sleep(0.25)
+        if data.loads.value == loads:
+            return loads
+        loads = data.loads.value
+    raise AssertionError('workers keep loading samples')
+
+
+def test_repeated_get():
+    data, fetcher = get_fetcher(10)
+    for _ in range(3):
+        assert fetcher.get(0) == 0
+    settle(data)
+    assert fetcher.get(0) == 0
+
+
+def test_small_dataset():
+    data, fetcher = get_fetcher(3)
+    for index in (0, 1, 2, 0, 2, 1):
+        assert fetcher.get(index) == index
+    settle(data)
+    assert set(fetcher.buffer) <= {0, 1, 2}
+    assert all(index is None for index in fetcher.sampler.dispatched)
+
+
+def test_idle_after_prefetch():
+    data, fetcher = get_fetcher(1000)
+    for index in (0, 500, 0, 500):
+        assert fetcher.get(index) == index
+    loads = settle(data)
+    time.sleep(1)
+    assert data.loads.value == loads
+    assert loads < 20
+
+
+def test_follow_navigation():
+    data, fetcher = get_fetcher(100)
+    for index in range(10):
+        assert fetcher.get(index) == index
+    settle(data)
+    assert set(fetcher.buffer) == set(range(10, 18))
+
+    # Changing direction does not wait for the stale samples
+    start = time.perf_counter()
+    assert fetcher.get(5) == 5
+    assert time.perf_counter() - start < 0.5
+    for index in range(4, -1, -1):
+        assert fetcher.get(index) == index
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from ibb._util import simplify_coords
+from ibb.widgets._image_canvas import _pack_coords
+
+
+def circle(num, radius=50):
+    angle = np.linspace(0, 2 * np.pi, num, endpoint=False)
+    return np.stack((radius * np.cos(angle), radius * np.sin(angle)), axis=1)
+
+
+def square(num, size=50):
+    edge = np.linspace(0, size, num, endpoint=False)
+    zero, full = np.zeros(num), np.full(num, size)
+    x = np.concatenate((edge, full, size - edge, zero, [0]))
+    y = np.concatenate((zero, edge, full, size - edge, [0]))
+    return np.stack((x, y), axis=1)
+
+
+def line(num):
+    return np.stack((np.arange(num), np.zeros(num)), axis=1)
+
+
+def check(polygons, tolerance=1):
+    coords, offsets = _pack_coords(polygons)
+    new_coords, new_offsets = simplify_coords(coords, offsets, tolerance)
+
+    assert new_offsets.dtype == offsets.dtype
+    assert len(new_offsets) == len(offsets)
+    assert new_offsets[-1] == len(new_coords)
+    return [new_coords[start:end] for start, end in zip(new_offsets[:-1], new_offsets[1:])]
+
+
+def simplify_single(polygon, tolerance=1):
+    coords, offsets = _pack_coords([polygon])
+    return simplify_coords(coords, offsets, tolerance)[0]
+
+
+@pytest.mark.parametrize('position', [0, 1, 2])
+def test_empty_polygon(position):
+    polygons = [circle(100), square(10)]
+    polygons.insert(position, np.empty((0, 2)))
+    result = check(polygons)
+
+    for polygon, simplified in zip(polygons, result):
+        if len(polygon) == 0:
+            assert len(simplified) == 0
+        else:
+            assert len(simplified) < len(polygon)
+            np.testing.assert_array_equal(simplified, simplify_single(polygon))
+
+
+def test_only_empty_polygons():
+    result = check([np.empty((0, 2)), np.empty((0, 2))])
+    assert [len(r) for r in result] == [0, 0]
+
+
+def test_no_polygons():
+    result = check([])
+    assert result == []
+
+
+def test_small_polygon():
+    result = check([line(20), np.empty((0, 2)), square(10)])
+    assert [len(r) for r in result] == [20, 0, 5]
+    np.testing.assert_array_equal(result[0], line(20))